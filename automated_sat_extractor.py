@@ -11,10 +11,10 @@ import subprocess
 import threading
 import argparse
 import shutil
-import math
 import re
 from datetime import datetime
 import PyPDF2
+from split_pdf import write_pages
 
 class CompleteSATAutomation:
     def __init__(self):
@@ -50,8 +50,6 @@ class CompleteSATAutomation:
                 pdf_reader = PyPDF2.PdfReader(file)
                 total_pages = len(pdf_reader.pages)
                 
-                num_files = math.ceil(total_pages / pages_per_file)
-                
                 # Create directory to hold the split files
                 base_name = os.path.splitext(input_file)[0]
                 output_dir = f"{base_name}_split"
@@ -59,20 +57,13 @@ class CompleteSATAutomation:
                 if not os.path.exists(output_dir):
                     os.makedirs(output_dir)
                 
-                for i in range(num_files):
-                    start_page = i * pages_per_file
-                    end_page = min((i + 1) * pages_per_file, total_pages)
-                    
-                    pdf_writer = PyPDF2.PdfWriter()
-                    
-                    for page_num in range(start_page, end_page):
-                        pdf_writer.add_page(pdf_reader.pages[page_num])
+                for i, start_page in enumerate(range(0, total_pages, pages_per_file)):
+                    end_page = min(start_page + pages_per_file, total_pages)
                     
                     output_filename = f"{os.path.basename(base_name)}_part{i+1:02d}_pages{start_page+1}-{end_page}.pdf"
                     output_path = os.path.join(output_dir, output_filename)
                     
-                    with open(output_path, 'wb') as output_file:
-                        pdf_writer.write(output_file)
+                    write_pages(pdf_reader, start_page, end_page, output_path)
                     
                 return output_dir
                 
@@ -5,84 +5,71 @@ Extract all explanations from PDF, then select longest version when duplicates e
 """
 
 import os
-import json
+import sys
+import orjson
 import time
+import random
+import asyncio
+import logging
+from operator import attrgetter
 from dotenv import load_dotenv
 from google import genai
 from google.genai import types
-from concurrent.futures import ThreadPoolExecutor, as_completed
-import threading
-from pydantic import BaseModel
-from typing import List, Optional
+from pydantic import BaseModel, TypeAdapter
+from typing import List, NamedTuple, Optional
+from gemini_common import (RATE_LIMIT_PATTERN, RateLimiter, is_retryable_error, file_content_hash,
+                           upload_pdf, delete_uploaded_file, ResultCache, attribute_items)
 
 # Load environment variables
 load_dotenv()
 
-# Pydantic models for structured output
-class Explanation(BaseModel):
-    id: str
-    correct_answer: str
-    explanation: str
-    is_complete: bool = True
+logger = logging.getLogger(__name__)
 
-class ExplanationsResponse(BaseModel):
-    explanations: List[Explanation]
+# Uploads run ahead of generation with their own concurrency limit
+UPLOAD_CONCURRENCY = 2
 
-class SimplifiedBatchExplanationExtractor:
-    def __init__(self):
-        self.api_key = os.getenv('GEMINI_KEY')
-        if not self.api_key:
-            raise ValueError("GEMINI_KEY not found in environment variables.")
-        
-        # Initialize client với API key
-        self.client = genai.Client(api_key=self.api_key)
-        
-        # Tracking
-        self.total_explanations_extracted = 0
-        self.lock = threading.Lock()  # For thread-safe operations
-        
-    def extract_with_retry(self, pdf_path, file_index=1, max_retries=3):
-        """Extract explanations from PDF with retry logic for network errors"""
-        
-        for attempt in range(max_retries):
-            try:
-                result = self.extract_explanations_from_pdf(pdf_path, file_index)
-                
-                if 'error' not in result:
-                    return result
-                
-                if attempt < max_retries - 1:
-                    wait_time = (attempt + 1) * 2  # 2, 4, 6 seconds
-                    print(f"⏳ Error occurred, waiting {wait_time}s before retry...")
-                    time.sleep(wait_time)
-                    continue
-                else:
-                    print(f"❌ All {max_retries} attempts failed for {os.path.basename(pdf_path)}")
-                    return result
+# First attempt uses the cheap model, retries escalate to the main one (--model)
+FIRST_PASS_MODEL = 'gemini-2.5-flash-lite'
+DEFAULT_MODEL = 'gemini-2.5-flash'
 
-            except Exception as e:
-                if attempt == max_retries - 1:
-                    return {"error": f"Failed after {max_retries} attempts: {str(e)}"}
-                
-                wait_time = (attempt + 1) * 2
-                time.sleep(wait_time)
-        
-        return {"error": "Unexpected error in retry logic"}
-    
-    def extract_explanations_from_pdf(self, pdf_path, file_index=1):
-        """Extract explanations from PDF using structured output"""
-        
-        print(f"📄 Processing file {file_index}: {os.path.basename(pdf_path)}")
-        
-        # Read PDF file
-        with open(pdf_path, 'rb') as f:
-            pdf_data = f.read()
-        
-        print(f"📊 File size: {len(pdf_data)} bytes")
-        
-        # Enhanced extraction prompt for structured output - matching questions complexity
-        extraction_prompt = f"""
-TASK: Extract ALL SAT explanations from this PDF file ({os.path.basename(pdf_path)})
+# Retry backoff: exponential with full jitter, bounded by an overall deadline (seconds)
+RETRY_BASE_DELAY = 1
+RETRY_MAX_DELAY = 30
+RETRY_DEADLINE = 120
+
+# Output cap per request, also reserved against the tokens-per-minute budget.
+# First attempts get a budget scaled to the PDF size; thinking tokens count against it too.
+MAX_OUTPUT_TOKENS = 65536
+OUTPUT_TOKENS_BASE = 8192
+OUTPUT_TOKENS_PER_KB = 50
+
+# Concurrent generation requests; keep it within what your API tier's RPM allows
+DEFAULT_WORKERS = 16
+
+# Default request and token budgets per minute (Gemini paid tier 1 for 2.5 Flash)
+DEFAULT_REQUESTS_PER_MINUTE = 1000
+DEFAULT_TOKENS_PER_MINUTE = 1000000
+
+# Responses are cached by PDF content; bump the version whenever the prompt changes
+PROMPT_VERSION = "v3"
+DEFAULT_CACHE_DIR = ".explanation_cache"
+
+def output_token_budget(size):
+    """Output token cap for a PDF of the given size in bytes"""
+    return min(MAX_OUTPUT_TOKENS, OUTPUT_TOKENS_BASE + OUTPUT_TOKENS_PER_KB * (size // 1024))
+
+class PdfJob(NamedTuple):
+    """A PDF to extract, with its name, position in the merge order, size and content hash resolved once"""
+    path: str
+    basename: str
+    index: int
+    size: int
+    content_hash: str
+
+# Enhanced extraction prompt for structured output - matching questions complexity.
+# It is identical for every PDF; the file name goes in the user turn.
+EXTRACTION_PROMPT = """
+TASK: Extract ALL SAT explanations from the attached PDF file
 
 You will get a list of PDF files that are splited from a single PDF file containing SAT explanations for questions. You will need to extract all explanations from each PDF file.
 
@@ -120,47 +107,169 @@ IMPORTANT FORMATTING RULES:
 
 Extract all explanations and explanation fragments from this PDF with maximum accuracy and completeness.
 """
+
+class ExplanationRecord(NamedTuple):
+    """One extracted explanation as read back from the staging file"""
+    id: str
+    correct_answer: str
+    explanation: str
+    is_complete: bool
+    source_file: str
+    file_index: int
+
+# Pydantic models for structured output
+class Explanation(BaseModel):
+    id: str
+    correct_answer: str
+    explanation: str
+    is_complete: bool = True
+
+class ExplanationsResponse(BaseModel):
+    explanations: List[Explanation]
+
+# Dumps a whole list of explanations in one pydantic-core call
+EXPLANATION_LIST_ADAPTER = TypeAdapter(List[Explanation])
+
+class SimplifiedBatchExplanationExtractor:
+    def __init__(self, model=DEFAULT_MODEL):
+        self.api_key = os.getenv('GEMINI_KEY')
+        if not self.api_key:
+            raise ValueError("GEMINI_KEY not found in environment variables.")
+        
+        # Initialize client với API key
+        self.client = genai.Client(api_key=self.api_key)
+        
+        # Model tried on each attempt, the last one repeating for any further retries
+        self.models = [FIRST_PASS_MODEL, model] if model != FIRST_PASS_MODEL else [model]
+        
+        # Shared across all concurrent extractions, created per run
+        self.rate_limiter = None
+        self.result_cache = None
+        
+        # Tracking
+        self.total_explanations_extracted = 0
+        self.retry_count = 0
+        self.backoff_count = 0
+        
+    async def upload_pdf(self, job):
+        """Upload PDF to the Gemini Files API so generation requests only carry a file reference"""
+        logger.debug("⬆️ Uploading %s...", job.basename)
+        return await upload_pdf(self.client, job.path)
+    
+    async def delete_uploaded_file(self, uploaded_file):
+        """Remove an uploaded PDF from the Files API, ignoring failures"""
+        await delete_uploaded_file(self.client, uploaded_file)
+    
+    async def extract_with_retry(self, job, max_retries=3, upload=None, deadline=RETRY_DEADLINE):
+        """Extract explanations from PDF with retry logic for network errors"""
+        
+        deadline_at = time.monotonic() + deadline
+        uploaded_file = None
+        result = {"error": "Unexpected error in retry logic"}
+        
+        try:
+            for attempt in range(max_retries):
+                try:
+                    if uploaded_file is None:
+                        # Reuse the upload across retries; upload again only if the first one failed
+                        if upload is not None and attempt == 0:
+                            uploaded_file = await upload
+                        else:
+                            uploaded_file = await self.upload_pdf(job)
+                    
+                    model = self.models[min(attempt, len(self.models) - 1)]
+                    
+                    # A first answer cut off by the scaled budget is retried with the full cap
+                    max_output_tokens = output_token_budget(job.size) if attempt == 0 else MAX_OUTPUT_TOKENS
+                    result = await self.extract_explanations_from_pdf(job, uploaded_file, model, max_output_tokens)
+                    
+                    if 'error' not in result:
+                        if self.rate_limiter:
+                            self.rate_limiter.restore()
+                        return result
+                
+                except Exception as e:
+                    result = {"error": str(e)}
+                
+                if not is_retryable_error(result['error']):
+                    logger.error("❌ Non-retryable error for %s: %s", job.basename, result['error'])
+                    return result
+                
+                if attempt == max_retries - 1:
+                    logger.error("❌ All %d attempts failed for %s", max_retries, job.basename)
+                    return result
+                
+                self.retry_count += 1
+                
+                # Rate limits are paced by the limiter, so retry without an extra backoff sleep
+                if self.rate_limiter and RATE_LIMIT_PATTERN.search(result['error']):
+                    self.rate_limiter.throttle()
+                    continue
+                
+                # Full jitter keeps concurrent workers from retrying in lockstep
+                wait_time = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+                if time.monotonic() + wait_time > deadline_at:
+                    logger.error("❌ Retry deadline of %ss reached for %s", deadline, job.basename)
+                    return result
+                
+                logger.warning("⏳ %s failed (%s), waiting %.1fs before retry...", job.basename, result['error'], wait_time)
+                self.backoff_count += 1
+                await asyncio.sleep(wait_time)
+            
+            return result
+        finally:
+            # Uploaded files would otherwise linger until the 48 hour expiry
+            if uploaded_file is not None:
+                await self.delete_uploaded_file(uploaded_file)
+    
+    async def extract_explanations_from_pdf(self, job, uploaded_file=None, model=DEFAULT_MODEL, max_output_tokens=MAX_OUTPUT_TOKENS):
+        """Extract explanations from PDF using structured output"""
+        
+        logger.debug("📄 Processing file %d: %s (%d bytes)", job.index, job.basename, job.size)
+        
+        if uploaded_file is None:
+            uploaded_file = await self.upload_pdf(job)
         
         try:
-            print("🤖 Processing with Gemini using structured output...")
+            if self.rate_limiter:
+                # Rough input estimate of 4 bytes per token, plus the full output allowance
+                await self.rate_limiter.acquire(job.size // 4 + max_output_tokens)
+            
+            logger.debug("🤖 Processing %s with %s using structured output...", job.basename, model)
             
             # Call API with structured output
-            response = self.client.models.generate_content(
-                model="gemini-2.5-pro",
-                contents=[
-                    types.Part.from_bytes(
-                        data=pdf_data,
-                        mime_type='application/pdf',
-                    ),
-                ],
+            response = await self.client.aio.models.generate_content(
+                model=model,
+                contents=[uploaded_file, f"PDF file: {job.basename}"],
                 config=types.GenerateContentConfig(
-                    system_instruction=extraction_prompt,
+                    system_instruction=EXTRACTION_PROMPT,
                     temperature=0.7,
-                    max_output_tokens=65536,
+                    max_output_tokens=max_output_tokens,
                     response_mime_type="application/json",
                     response_schema=ExplanationsResponse,
                 )
             )
             
-            print(f"✅ Structured output received successfully")
-            
             # Access parsed response directly
             if hasattr(response, 'parsed') and response.parsed:
                 parsed_response = response.parsed
                 explanations = parsed_response.explanations
                 
-                print(f"✅ Extracted {len(explanations)} explanations from {os.path.basename(pdf_path)}")
+                # An empty result is worth another attempt on the stronger model
+                if not explanations:
+                    return {"error": f"No explanations returned by {model}"}
+                
+                logger.info("✅ Extracted %d explanations from %s with %s", len(explanations), job.basename, model)
                 
                 # Convert to dict format for compatibility with existing code
-                explanations_dict = []
-                for explanation in explanations:
-                    explanation_data = explanation.model_dump()
-                    explanation_data['source_file'] = os.path.basename(pdf_path)
-                    explanation_data['file_index'] = file_index
-                    explanations_dict.append(explanation_data)
+                explanations_dict = EXPLANATION_LIST_ADAPTER.dump_python(explanations)
+                for explanation_data in explanations_dict:
+                    explanation_data['source_file'] = job.basename
+                    explanation_data['file_index'] = job.index
                 
                 return {
-                    "explanations": explanations_dict
+                    "explanations": explanations_dict,
+                    "model_used": model
                 }
                 
             else:
@@ -169,120 +278,192 @@ Extract all explanations and explanation fragments from this PDF with maximum ac
         except Exception as e:
             return {"error": str(e)}
     
+    def merge_explanation_run(self, run):
+        """Combine an incomplete explanation with the fragments that continue it"""
+        
+        first = run[0]
+        source_files = [exp.source_file for exp in run]
+        
+        # Join once at the end instead of growing a string per fragment
+        parts = (exp.explanation.strip() for exp in run)
+        merged_explanation = {
+            'id': first.id,
+            'correct_answer': first.correct_answer,
+            'explanation': ' '.join(part for part in parts if part),
+            'is_complete': True,
+            'source_file': ' + '.join(source_files) if len(source_files) > 1 else source_files[0],
+            'file_index': first.file_index
+        }
+        
+        if len(run) > 1:
+            merged_notes = [f"Merged with {exp.id}" for exp in run[1:]]
+            merged_explanation['merged_from'] = f"{len(run)} explanations"
+            merged_explanation['notes'] = f"Merged {len(run)} explanations: " + '; '.join(merged_notes)
+        
+        logger.debug("Created merged explanation %s from %d parts", first.id, len(run))
+        return merged_explanation
+    
     def merge_incomplete_explanations(self, explanations):
         """Merge consecutive explanations when is_complete=false with subsequent explanations until is_complete=true"""
         
-        print(f"🔗 Merging incomplete explanations from {len(explanations)} explanations...")
-        
-        # Check how many incomplete explanations we have
-        incomplete_count = sum(1 for exp in explanations if not exp.get('is_complete', True))
-        print(f"🔍 Found {incomplete_count} incomplete explanations to process")
+        logger.debug("🔗 Merging incomplete explanations from %d explanations...", len(explanations))
         
         # Sort explanations by file_index first, then by id to ensure proper order
-        explanations_sorted = sorted(explanations, key=lambda x: (x.get('file_index', 0), x.get('id', '')))
+        explanations_sorted = sorted(explanations, key=attrgetter('file_index', 'id'))
         
         merged = []
-        i = 0
-        
-        while i < len(explanations_sorted):
-            current = explanations_sorted[i]
+        incomplete_count = 0
+        current_run = None
+        
+        # An incomplete explanation absorbs everything after it up to and including the next complete one
+        for explanation in explanations_sorted:
+            is_complete = explanation.is_complete
+            if not is_complete:
+                incomplete_count += 1
             
-            # Check if current explanation is incomplete
-            if not current.get('is_complete', True):
-                print(f"🔍 Found incomplete explanation: {current.get('id')} from {current.get('source_file', 'unknown')}")
-                
-                # Start merging - collect all consecutive explanations until we find a complete one
-                merged_explanation_text = current.get('explanation', '').strip()
-                merged_id = current.get('id')
-                merged_answer = current.get('correct_answer')
-                source_files = [current.get('source_file', '')]
-                merged_notes = []
-                
-                # Look ahead for continuation
-                j = i + 1
-                merged_count = 1
-                
-                while j < len(explanations_sorted):
-                    next_exp = explanations_sorted[j]
-                    next_text = next_exp.get('explanation', '').strip()
-                    next_complete = next_exp.get('is_complete', True)
-                    next_id = next_exp.get('id', '')
-                    
-                    print(f"   Checking next explanation {next_id}: complete={next_complete}")
-                    
-                    # Add the next explanation text
-                    if merged_explanation_text and not merged_explanation_text.endswith(' '):
-                        merged_explanation_text += ' '
-                    merged_explanation_text += next_text
-                    
-                    source_files.append(next_exp.get('source_file', ''))
-                    merged_notes.append(f"Merged with {next_id}")
-                    merged_count += 1
-                    
-                    print(f"     ✅ Merged explanation from {next_id}")
-                    
-                    # If this explanation is complete, we're done merging
-                    if next_complete:
-                        print(f"   ✅ Found complete explanation, finished merging {merged_count} parts")
-                        break
-                    
-                    j += 1
-                
-                # Create merged explanation
-                merged_explanation = {
-                    'id': merged_id,
-                    'correct_answer': merged_answer,
-                    'explanation': merged_explanation_text,
-                    'is_complete': True,
-                    'source_file': ' + '.join(source_files) if len(source_files) > 1 else source_files[0],
-                    'file_index': current.get('file_index', 1)
-                }
-                
-                if merged_count > 1:
-                    merged_explanation['merged_from'] = f"{merged_count} explanations"
-                    merged_explanation['notes'] = f"Merged {merged_count} explanations: " + '; '.join(merged_notes)
-                
-                merged.append(merged_explanation)
-                print(f"   ✅ Created merged explanation from {merged_count} parts")
-                
-                # Skip all the explanations we just merged
-                i = j + 1
+            if current_run is None:
+                if is_complete:
+                    merged.append(explanation._asdict())
+                    continue
                 
-            else:
-                # Complete explanation, add as-is
-                merged.append(current)
-                i += 1
+                logger.debug("Found incomplete explanation %s from %s", explanation.id, explanation.source_file)
+                current_run = [explanation]
+                continue
+            
+            current_run.append(explanation)
+            if is_complete:
+                merged.append(self.merge_explanation_run(current_run))
+                current_run = None
         
-        print(f"📊 After merging incomplete: {len(explanations)} → {len(merged)} explanations")
+        # A run still open at the end has no continuation left to wait for
+        if current_run:
+            merged.append(self.merge_explanation_run(current_run))
+        
+        logger.info("🔍 Found %d incomplete explanations", incomplete_count)
+        logger.info("📊 After merging incomplete: %d → %d explanations", len(explanations), len(merged))
         return merged
     
     def reassign_explanation_ids(self, explanations):
         """Reassign sequential explanation IDs"""
         
-        print("🔢 Reassigning explanation IDs sequentially...")
+        logger.debug("🔢 Reassigning explanation IDs sequentially...")
         
         for i, explanation in enumerate(explanations, 1):
             explanation['id'] = f"q_{i:03d}"
         
         return explanations
     
-    def process_directory(self, input_dir, output_file="batch_explanations_simplified.json", max_files=None, parallel=True):
+    def result_for_job(self, result, job):
+        """Copy an extraction result with its explanations attributed to another PDF of the same content"""
+        return attribute_items(result, 'explanations', job.basename, job.index)
+    
+    async def extract_file(self, job, semaphore, upload_semaphore):
+        """Upload and extract one PDF; the upload starts before waiting for a generation slot"""
+        
+        cache_file = None
+        if self.result_cache:
+            cache_file = self.result_cache.path(job.content_hash)
+            cached_result = self.result_cache.load(cache_file, job.basename, job.index)
+            if cached_result:
+                logger.info("💾 Cache hit for %s", job.basename)
+                return job, cached_result
+        
+        async def upload():
+            async with upload_semaphore:
+                return await self.upload_pdf(job)
+        
+        upload_task = asyncio.ensure_future(upload())
+        
+        try:
+            async with semaphore:
+                result = await self.extract_with_retry(job, upload=upload_task)
+        except Exception as e:
+            logger.error("❌ Exception processing %s: %s", job.basename, e)
+            result = {"error": str(e)}
+        
+        if cache_file and 'error' not in result:
+            self.result_cache.save(cache_file, result)
+        
+        return job, result
+    
+    async def extract_files(self, jobs, concurrency, staging):
+        """Extract all PDFs on one event loop, streaming each result to the staging file as it completes"""
+        
+        explanation_count = 0
+        successful_files = []
+        failed_files = []
+        model_usage = {}
+        
+        semaphore = asyncio.Semaphore(concurrency)
+        upload_semaphore = asyncio.Semaphore(UPLOAD_CONCURRENCY)
+        
+        # Identical PDFs are extracted once; the result is copied to every file with that content
+        copies = {}
+        for job in jobs:
+            copies.setdefault(job.content_hash, []).append(job)
+        
+        # file_index follows name order for merging, but the largest files launch first
+        unique_jobs = [same_content[0] for same_content in copies.values()]
+        if len(unique_jobs) < len(jobs):
+            logger.info("♻️ %d duplicate PDFs will reuse the result of an identical file", len(jobs) - len(unique_jobs))
+        tasks = [
+            asyncio.ensure_future(self.extract_file(job, semaphore, upload_semaphore))
+            for job in sorted(unique_jobs, key=attrgetter('size'), reverse=True)
+        ]
+        
+        # Process completed tasks
+        completed_count = 0
+        for next_completed in asyncio.as_completed(tasks):
+            job, result = await next_completed
+            
+            for same_content_job in copies[job.content_hash]:
+                completed_count += 1
+                
+                if result and 'explanations' in result:
+                    if same_content_job is not job:
+                        logger.debug("♻️ Reusing the result of %s for %s", job.basename, same_content_job.basename)
+                        result = self.result_for_job(result, same_content_job)
+                    
+                    explanations = result['explanations']
+                    if explanations:
+                        for explanation in explanations:
+                            staging.write(orjson.dumps(explanation) + b'\n')
+                        staging.flush()
+                        explanation_count += len(explanations)
+                        successful_files.append(same_content_job)
+                        # Counted per PDF, so copies that reused one response each count toward its model
+                        model = result.get('model_used')
+                        model_usage[model] = model_usage.get(model, 0) + 1
+                    else:
+                        failed_files.append(same_content_job)
+                else:
+                    logger.error("❌ FAILED: %s: %s", same_content_job.basename, result.get('error', 'unknown error'))
+                    failed_files.append(same_content_job)
+                
+                logger.info("📊 Completed %d/%d files, %d explanations so far", completed_count, len(jobs), explanation_count)
+        
+        return successful_files, failed_files, model_usage
+    
+    def process_directory(self, input_dir, output_file="batch_explanations_simplified.json", max_files=None, parallel=True,
+                          requests_per_minute=DEFAULT_REQUESTS_PER_MINUTE, tokens_per_minute=DEFAULT_TOKENS_PER_MINUTE,
+                          cache_dir=DEFAULT_CACHE_DIR, workers=DEFAULT_WORKERS):
         """Process all PDF files in directory"""
         
-        print(f"🔄 SIMPLIFIED BATCH EXPLANATION EXTRACTION")
-        print(f"📁 Input directory: {input_dir}")
-        print(f"📄 Output file: {output_file}")
-        print(f"⚡ Processing mode: {'Parallel' if parallel else 'Sequential'}")
+        logger.info("🔄 SIMPLIFIED BATCH EXPLANATION EXTRACTION")
+        logger.info("📁 Input directory: %s", input_dir)
+        logger.info("📄 Output file: %s", output_file)
+        logger.info("⚡ Processing mode: %s", 'Parallel' if parallel else 'Sequential')
         
-        # Find all PDF files
+        # Find all PDF files, keeping their sizes from the directory scan
         pdf_files = []
         if os.path.exists(input_dir):
-            for file in os.listdir(input_dir):
-                if file.lower().endswith('.pdf'):
-                    pdf_files.append(os.path.join(input_dir, file))
+            with os.scandir(input_dir) as entries:
+                for entry in entries:
+                    if entry.is_file() and entry.name.lower().endswith('.pdf'):
+                        pdf_files.append((entry.path, entry.name, entry.stat().st_size))
         
         if not pdf_files:
-            print(f"❌ No PDF files found in {input_dir}")
+            logger.error("❌ No PDF files found in %s", input_dir)
             return
         
         # Sort files to ensure order
@@ -291,76 +472,48 @@ Extract all explanations and explanation fragments from this PDF with maximum ac
         # Limit files if max_files is specified
         if max_files and max_files > 0:
             pdf_files = pdf_files[:max_files]
-            print(f"📊 Found {len(pdf_files)} PDF files (limited to first {max_files})")
+            logger.info("📊 Found %d PDF files (limited to first %d)", len(pdf_files), max_files)
         else:
-            print(f"📊 Found {len(pdf_files)} PDF files")
+            logger.info("📊 Found %d PDF files", len(pdf_files))
+        
+        jobs = [
+            PdfJob(path, name, i, size, file_content_hash(path))
+            for i, (path, name, size) in enumerate(pdf_files, 1)
+        ]
         
         # Process each file
-        all_explanations = []
-        successful_files = []
-        failed_files = []
+        concurrency = max(1, min(workers, len(pdf_files))) if parallel else 1
+        self.rate_limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+        self.result_cache = ResultCache(cache_dir, PROMPT_VERSION, 'explanations', ('model_used',)) if cache_dir else None
+        logger.info("🚀 Starting %s processing with %d concurrent requests...", 'parallel' if parallel else 'sequential', concurrency)
         
-        if parallel:
-            # PARALLEL PROCESSING
-            print(f"🚀 Starting parallel processing with {min(4, len(pdf_files))} workers...")
+        # Explanations are staged as JSON lines while extraction runs, then read back for merging
+        staging_file = output_file + '.jsonl'
+        try:
+            with open(staging_file, 'wb') as staging:
+                successful_files, failed_files, model_usage = asyncio.run(
+                    self.extract_files(jobs, concurrency, staging)
+                )
             
-            with ThreadPoolExecutor(max_workers=min(4, len(pdf_files))) as executor:
-                # Submit all tasks
-                future_to_file = {}
-                for i, pdf_file in enumerate(pdf_files, 1):
-                    future = executor.submit(self.extract_with_retry, pdf_file, i)
-                    future_to_file[future] = (pdf_file, i)
-                
-                # Process completed tasks
-                completed_count = 0
-                for future in as_completed(future_to_file):
-                    pdf_file, file_index = future_to_file[future]
-                    completed_count += 1
-                    
-                    print(f"\n{'='*60}")
-                    print(f"COMPLETED FILE {completed_count}/{len(pdf_files)}: {os.path.basename(pdf_file)}")
-                    print(f"{'='*60}")
-                    
-                    try:
-                        result = future.result()
-                        
-                        if result and 'explanations' in result:
-                            explanations = result['explanations']
-                            if explanations:
-                                with self.lock:  # Thread-safe access
-                                    all_explanations.extend(explanations)
-                                    successful_files.append(pdf_file)
-                            else:
-                                with self.lock:
-                                    failed_files.append(pdf_file)
-                        else:
-                            print(f"❌ FAILED: Error processing file")
-                            with self.lock:
-                                failed_files.append(pdf_file)
-                            if result and 'error' in result:
-                                print(f"🐛 Error: {result['error']}")
-                        
-                        # Show progress
-                        with self.lock:
-                            print(f"📊 Total explanations so far: {len(all_explanations)}")
-                            
-                    except Exception as e:
-                        print(f"❌ Exception processing {os.path.basename(pdf_file)}: {e}")
-                        with self.lock:
-                            failed_files.append(pdf_file)
+            with open(staging_file, 'rb') as staging:
+                all_explanations = [ExplanationRecord(**orjson.loads(line)) for line in staging]
+        finally:
+            # Everything needed is in memory once read back, so the staging file never outlives the run
+            if os.path.exists(staging_file):
+                os.remove(staging_file)
         
         if not all_explanations:
-            print("❌ No explanations extracted from any file!")
+            logger.error("❌ No explanations extracted from any file!")
             return
         
         # SIMPLIFIED Post-processing pipeline - ONLY merge incomplete explanations
-        print(f"\n📝 POST-PROCESSING...")
+        logger.info("📝 POST-PROCESSING...")
         
         # IMPORTANT: Parallel processing works because:
         # 1. Each explanation is tagged with file_index for proper ordering
         # 2. merge_incomplete_explanations() sorts by file_index before merging
         # 3. The merge logic only depends on sorted order, not processing order
-        print(f"🔄 Sorting explanations by file order before merging...")
+        logger.debug("🔄 Sorting explanations by file order before merging...")
         
         # Step 1: ONLY merge incomplete explanations (is_complete: false)
         # This handles explanations that are split across PDF files
@@ -381,40 +534,43 @@ Extract all explanations and explanation fragments from this PDF with maximum ac
                 "incomplete_explanations_merged": len(all_explanations) - len(final_explanations),
                 "extraction_date": time.strftime('%Y-%m-%d %H:%M:%S'),
                 "extraction_method": "simplified_parallel_batch",
-                "model_used": "gemini-2.5-flash-preview-05-20"
+                "model_used": max(model_usage, key=model_usage.get),
+                "model_usage": model_usage,
+                "retry_count": self.retry_count,
+                "backoff_count": self.backoff_count
             }
         }
         
         # Add file lists
         if successful_files:
-            final_result["metadata"]["successful_files"] = [os.path.basename(f) for f in successful_files]
+            final_result["metadata"]["successful_files"] = [job.basename for job in successful_files]
         if failed_files:
-            final_result["metadata"]["failed_files"] = [os.path.basename(f) for f in failed_files]
+            final_result["metadata"]["failed_files"] = [job.basename for job in failed_files]
         
         # Save results
         try:
-            with open(output_file, 'w', encoding='utf-8') as f:
-                json.dump(final_result, f, ensure_ascii=False, indent=2)
+            with open(output_file, 'wb') as f:
+                f.write(orjson.dumps(final_result))
             
-            print(f"\n{'='*60}")
-            print(f"✅ EXTRACTION COMPLETED SUCCESSFULLY!")
-            print(f"{'='*60}")
-            print(f"📄 Output file: {output_file}")
-            print(f"📊 Total explanations: {len(final_explanations)}")
-            print(f"📊 Raw explanations extracted: {len(all_explanations)}")
-            print(f"📊 Incomplete explanations merged: {len(all_explanations) - len(final_explanations)}")
-            print(f"✅ Successful files: {len(successful_files)}")
-            print(f"❌ Failed files: {len(failed_files)}")
+            logger.info("=" * 60)
+            logger.info("✅ EXTRACTION COMPLETED SUCCESSFULLY!")
+            logger.info("=" * 60)
+            logger.info("📄 Output file: %s", output_file)
+            logger.info("📊 Total explanations: %d", len(final_explanations))
+            logger.info("📊 Raw explanations extracted: %d", len(all_explanations))
+            logger.info("📊 Incomplete explanations merged: %d", len(all_explanations) - len(final_explanations))
+            logger.info("✅ Successful files: %d", len(successful_files))
+            logger.info("❌ Failed files: %d", len(failed_files))
             
             if final_explanations:
-                print(f"\n📝 Sample explanation:")
+                logger.info("📝 Sample explanation:")
                 sample = final_explanations[0]
-                print(f"   ID: {sample.get('id', 'N/A')}")
-                print(f"   Answer: {sample.get('correct_answer', 'N/A')}")
-                print(f"   Explanation: {sample.get('explanation', '')[:150]}...")
+                logger.info("   ID: %s", sample.get('id', 'N/A'))
+                logger.info("   Answer: %s", sample.get('correct_answer', 'N/A'))
+                logger.info("   Explanation: %s...", sample.get('explanation', '')[:150])
             
         except Exception as e:
-            print(f"❌ Failed to save results: {e}")
+            logger.error("❌ Failed to save results: %s", e)
 
 def main():
     """Main function"""
@@ -426,9 +582,17 @@ def main():
     parser.add_argument('--max-files', type=int, default=None, help='Maximum number of files to process (for testing)')
     parser.add_argument('--parallel', action='store_true', default=True, help='Use parallel processing (default)')
     parser.add_argument('--sequential', action='store_true', help='Use sequential processing instead of parallel')
+    parser.add_argument('--model', default=DEFAULT_MODEL, help=f'Model used when the {FIRST_PASS_MODEL} first pass needs a retry')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help='Number of concurrent extraction requests')
+    parser.add_argument('--rpm', type=int, default=DEFAULT_REQUESTS_PER_MINUTE, help='Requests per minute allowed by your API tier')
+    parser.add_argument('--tpm', type=int, default=DEFAULT_TOKENS_PER_MINUTE, help='Tokens per minute allowed by your API tier')
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR, help='Directory for cached responses, keyed by PDF content')
+    parser.add_argument('--no-cache', action='store_true', help='Always call the API, ignoring and not writing the cache')
     
     args = parser.parse_args()
     
+    logging.basicConfig(stream=sys.stdout, level=os.getenv('LOG_LEVEL', 'INFO').upper(), format='%(asctime)s %(message)s')
+    
     if not os.path.exists(args.input_dir):
         print(f"❌ Directory not found: {args.input_dir}")
         return
@@ -437,8 +601,10 @@ def main():
     parallel_mode = args.parallel and not args.sequential
     
     try:
-        extractor = SimplifiedBatchExplanationExtractor()
-        extractor.process_directory(args.input_dir, args.output, max_files=args.max_files, parallel=parallel_mode)
+        extractor = SimplifiedBatchExplanationExtractor(model=args.model)
+        extractor.process_directory(args.input_dir, args.output, max_files=args.max_files, parallel=parallel_mode,
+                                    requests_per_minute=args.rpm, tokens_per_minute=args.tpm,
+                                    cache_dir=None if args.no_cache else args.cache_dir, workers=args.workers)
         
     except Exception as e:
         print(f"❌ Error: {e}")
@@ -5,23 +5,29 @@ Extract all questions from PDF, then select most complete version when duplicate
 """
 
 import os
-import json
+import sys
+import orjson
 import time
+import random
+import tempfile
 from dotenv import load_dotenv
 from google import genai
 from google.genai import types
-from difflib import SequenceMatcher
-import fitz  # PyMuPDF
 import re
-from concurrent.futures import ThreadPoolExecutor, as_completed
-import threading
+import asyncio
+import logging
+from operator import itemgetter
 from pydantic import BaseModel
 from typing import List, Optional
 from enum import Enum
+from gemini_common import (RATE_LIMIT_PATTERN, RateLimiter, is_retryable_error, file_content_hash,
+                           upload_pdf, delete_uploaded_file, ResultCache)
 
 # Load environment variables
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # Pydantic models for structured output
 class Option(BaseModel):
     value: str
@@ -59,51 +65,18 @@ class QuestionsResponse(BaseModel):
     totalCount: int
     questions: List[SATQuestion]
 
-class SimplifiedBatchSATExtractor:
-    def __init__(self):
-        self.api_key = os.getenv('GEMINI_KEY')
-        if not self.api_key:
-            raise ValueError("GEMINI_KEY not found in environment variables.")
-        
-        # Initialize client với API key
-        self.client = genai.Client(api_key=self.api_key)
-        
-        # Tracking
-        self.total_questions_extracted = 0
-        self.lock = threading.Lock()  # For thread-safe operations
-        
-    def extract_with_retry(self, pdf_path, file_index=1, max_retries=3):
-        """Extract questions from PDF with retry logic for network errors"""
-        
-        for attempt in range(max_retries):
-            try:
-                result = self.extract_questions_from_pdf(pdf_path, file_index)
-                
-                # If successful (no error key), return the result
-                if 'error' not in result:
-                    return result
-                
-                if attempt < max_retries - 1:
-                    wait_time = (attempt + 1) * 2  # 2, 4, 6 seconds
-                    print(f"⏳ Error occurred, waiting {wait_time}s before retry...")
-                    time.sleep(wait_time)
-                    continue
-                else:
-                    print(f"❌ All {max_retries} attempts failed for {os.path.basename(pdf_path)}")
-                    return result
+class BatchedSATQuestion(SATQuestion):
+    source_file_index: int
 
-            except Exception as e:
-                return {"error": f"Failed after {max_retries} attempts: {str(e)}"}
-        
-        return {"error": "Unexpected error in retry logic"}
-    
-    def extract_questions_from_pdf(self, pdf_path, file_index=1):
-        """Extract questions from PDF using structured output"""     
-        with open(pdf_path, 'rb') as f:
-            pdf_data = f.read()
-        
-        extraction_prompt = f"""
-TASK: Extract ALL SAT questions from this PDF file ({os.path.basename(pdf_path)})
+class BatchedQuestionsResponse(BaseModel):
+    totalCount: int
+    questions: List[BatchedSATQuestion]
+
+EXTRACTION_MODEL = "gemini-2.5-pro"
+
+# The prompt is identical for every PDF; the file name goes in the user turn
+EXTRACTION_PROMPT = """
+TASK: Extract ALL SAT questions from the attached PDF file
 
 CRITICAL INSTRUCTIONS FOR SPLIT PDF HANDLING:
 1. READ THE ENTIRE PDF CONTENT carefully - don't skip any text
@@ -182,92 +155,523 @@ COMPLETENESS DETECTION:
 
 Extract all questions and question fragments from this PDF.
 """
+
+BATCH_INSTRUCTIONS = """
+The PDF files above are consecutive parts of one document, numbered in order.
+Treat each file on its own exactly as described, and set source_file_index on every question
+to the number of the PDF file it was extracted from.
+"""
+
+# Texts less than half as long as each other are never treated as the same question
+MIN_LENGTH_RATIO = 0.5
+
+# With --batch-api, every PDF goes into one Gemini batch job that is polled until it finishes
+BATCH_POLL_SECONDS = 30
+BATCH_DONE_STATES = {'JOB_STATE_SUCCEEDED', 'JOB_STATE_PARTIALLY_SUCCEEDED', 'JOB_STATE_FAILED',
+                     'JOB_STATE_CANCELLED', 'JOB_STATE_EXPIRED'}
+
+# With --prefilter, PDFs whose text layer has no answer-choice markers are not sent to Gemini
+QUESTION_MARKER_PATTERN = re.compile(r'^\s*\(?[A-D][\)\.]\s', re.MULTILINE)
+
+# Default request and token budgets per minute (Gemini paid tier 1 for 2.5 Pro)
+DEFAULT_REQUESTS_PER_MINUTE = 150
+DEFAULT_TOKENS_PER_MINUTE = 2000000
+MAX_OUTPUT_TOKENS = 65536
+
+# Output allowance per PDF page, on top of a small fixed thinking budget (2.5 Pro cannot turn thinking off)
+OUTPUT_TOKENS_PER_PAGE = 2048
+EXTRACTION_THINKING_BUDGET = 128
+
+# With --batch-size, consecutive small PDFs share one request. Each PDF is a Files API reference, so the
+# request payload stays small; the bound is the single response they share, which must fit
+# OUTPUT_TOKENS_PER_PAGE for every page within MAX_OUTPUT_TOKENS
+BATCH_MAX_PAGES = (MAX_OUTPUT_TOKENS - EXTRACTION_THINKING_BUDGET) // OUTPUT_TOKENS_PER_PAGE
+
+# Concurrent extraction requests; the rate limiter keeps them within the per-minute budget
+DEFAULT_WORKERS = 16
+
+# PDFs longer than this many pages are split into page ranges extracted concurrently
+DEFAULT_SHARD_PAGES = 30
+
+# Responses are cached by PDF content; bump the version whenever the prompt or schema changes
+PROMPT_VERSION = "v1"
+DEFAULT_CACHE_DIR = ".question_cache"
+
+# Full-jitter exponential backoff between retries, in seconds
+RETRY_BASE_DELAY = 1
+RETRY_MAX_DELAY = 30
+
+class SimplifiedBatchSATExtractor:
+    def __init__(self):
+        self.api_key = os.getenv('GEMINI_KEY')
+        if not self.api_key:
+            raise ValueError("GEMINI_KEY not found in environment variables.")
+        
+        # Initialize client với API key
+        self.client = genai.Client(api_key=self.api_key)
+        
+        # Shared pacing for all concurrent requests, set up per run
+        self.rate_limiter = None
+        
+        # Per-PDF responses from earlier runs; None disables the cache
+        self.result_cache = None
+        
+        # Page counts of input PDFs and shards, counted once per run for sharding and output caps
+        self.page_counts = {}
+        
+        # Tracking
+        self.total_questions_extracted = 0
+        
+    async def extract_with_retry(self, pdf_batch, max_retries=3):
+        """Extract questions from a batch of (pdf_path, file_index) pairs with retry logic for network errors"""
+        
+        uploaded_files = []
+        try:
+            for attempt in range(max_retries):
+                try:
+                    # Reuse uploads across retries; only files that have not been uploaded yet are sent
+                    for pdf_path, _ in pdf_batch[len(uploaded_files):]:
+                        uploaded_files.append(await self.upload_pdf(pdf_path))
+                    
+                    # A response cut off by the page-scaled cap would be cut off again, so retries get the full allowance
+                    if attempt == 0:
+                        max_output_tokens = self.output_token_limit([pdf_path for pdf_path, _ in pdf_batch])
+                    else:
+                        max_output_tokens = MAX_OUTPUT_TOKENS
+                    
+                    if len(pdf_batch) == 1:
+                        pdf_path, file_index = pdf_batch[0]
+                        result = await self.extract_questions_from_pdf(pdf_path, file_index, uploaded_files[0], max_output_tokens)
+                    else:
+                        result = await self.extract_batch(pdf_batch, uploaded_files, max_output_tokens)
+                except Exception as e:
+                    result = {"error": str(e)}
+                
+                # If successful (no error key), return the result
+                if 'error' not in result:
+                    if self.rate_limiter:
+                        self.rate_limiter.restore()
+                    return result
+                
+                names = ', '.join(os.path.basename(p) for p, _ in pdf_batch)
+                if not is_retryable_error(result['error']):
+                    logger.error("❌ Non-retryable error for %s: %s", names, result['error'])
+                    return result
+                
+                if attempt == max_retries - 1:
+                    logger.error("❌ All %d attempts failed for %s", max_retries, names)
+                    return result
+                
+                # Rate limits are paced by the limiter, so retry without an extra backoff sleep
+                if self.rate_limiter and RATE_LIMIT_PATTERN.search(result['error']):
+                    self.rate_limiter.throttle()
+                    continue
+                
+                # Full jitter keeps concurrent workers from retrying in lockstep
+                wait_time = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+                logger.warning("⏳ %s failed (%s), waiting %.1fs before retry...", names, result['error'], wait_time)
+                await asyncio.sleep(wait_time)
+        finally:
+            # Remove uploads once the batch is done so they do not count against the Files API quota
+            for uploaded_file in uploaded_files:
+                await self.delete_uploaded_file(uploaded_file)
+        
+        return {"error": "Unexpected error in retry logic"}
+    
+    def output_token_limit(self, pdf_paths):
+        """Output token cap for a request, scaled by page count; PDFs without a known page count get the full MAX_OUTPUT_TOKENS"""
         
+        page_counts = [self.page_counts.get(pdf_path, 0) for pdf_path in pdf_paths]
+        if not all(page_counts):
+            return MAX_OUTPUT_TOKENS
+        return min(MAX_OUTPUT_TOKENS, sum(page_counts) * OUTPUT_TOKENS_PER_PAGE + EXTRACTION_THINKING_BUDGET)
+    
+    async def upload_pdf(self, pdf_path):
+        """Upload PDF to the Gemini Files API so generation requests only carry a file reference"""
+        return await upload_pdf(self.client, pdf_path)
+    
+    async def delete_uploaded_file(self, uploaded_file):
+        """Remove an uploaded PDF from the Files API, ignoring failures"""
+        await delete_uploaded_file(self.client, uploaded_file)
+    
+    async def extract_questions_from_pdf(self, pdf_path, file_index, uploaded_file, max_output_tokens=MAX_OUTPUT_TOKENS):
+        """Extract questions from an uploaded PDF using structured output"""     
         try:
-            response = self.client.models.generate_content(
-                model="gemini-2.5-pro",
+            if self.rate_limiter:
+                # Rough input estimate of 4 bytes per token, plus the output allowance
+                await self.rate_limiter.acquire(os.path.getsize(pdf_path) // 4 + max_output_tokens)
+            response = await self.client.aio.models.generate_content(
+                model=EXTRACTION_MODEL,
                 contents=[
-                    types.Part.from_bytes(
-                        data=pdf_data,
-                        mime_type='application/pdf',
-                    ),
+                    uploaded_file,
+                    f"PDF file: {os.path.basename(pdf_path)}",
                 ],
                 config=types.GenerateContentConfig(
-                    system_instruction=extraction_prompt,                    
+                    system_instruction=EXTRACTION_PROMPT,
                     temperature=0.7,
-                    max_output_tokens=65536,
+                    max_output_tokens=max_output_tokens,
+                    thinking_config=types.ThinkingConfig(thinking_budget=EXTRACTION_THINKING_BUDGET),
                     response_mime_type="application/json",
                     response_schema=QuestionsResponse,
                 )
             )
             
-            if hasattr(response, 'parsed') and response.parsed:
-                parsed_response = response.parsed
-                questions = parsed_response.questions
+            return self.questions_result(response, pdf_path, file_index)
                 
-                print(f"✅ Extracted {len(questions)} questions from {os.path.basename(pdf_path)}")
+        except Exception as e:
+            logger.error("❌ Error calling Gemini API: %s", e)
+            return {"error": str(e)}
+    
+    def questions_result(self, response, pdf_path, file_index):
+        """Turn a structured-output response for one PDF into the question dicts used downstream"""
+        
+        parsed_response = response.parsed if hasattr(response, 'parsed') else None
+        if not parsed_response and response.text:
+            # The SDK leaves parsed empty when validation fails; retry with orjson before giving up
+            try:
+                parsed_response = QuestionsResponse.model_validate(orjson.loads(response.text))
+            except ValueError as e:
+                logger.warning("⚠️ Could not parse raw response: %s", e)
+        
+        if parsed_response:
+            questions = parsed_response.questions
+            
+            logger.info("✅ Extracted %d questions from %s", len(questions), os.path.basename(pdf_path))
+            
+            # Convert to dict format for compatibility with existing code
+            questions_dict = []
+            for question in questions:
+                question_data = question.model_dump()
+                question_data['source_file'] = os.path.basename(pdf_path)
+                question_data['file_index'] = file_index
+                questions_dict.append(question_data)
+            
+            return {
+                "totalCount": parsed_response.totalCount,
+                "questions": questions_dict
+            }
+            
+        else:
+            logger.error("❌ No parsed response available")
+            return {"error": "No parsed response available"}
+    
+    async def extract_batch(self, pdf_batch, uploaded_files, max_output_tokens=MAX_OUTPUT_TOKENS):
+        """Extract questions from several uploaded PDFs in one request, split back per file by source_file_index"""
+        
+        try:
+            contents = []
+            for n, ((pdf_path, _), uploaded_file) in enumerate(zip(pdf_batch, uploaded_files), 1):
+                contents.append(f"PDF file {n}: {os.path.basename(pdf_path)}")
+                contents.append(uploaded_file)
+            contents.append(BATCH_INSTRUCTIONS)
+            
+            if self.rate_limiter:
+                batch_bytes = sum(os.path.getsize(pdf_path) for pdf_path, _ in pdf_batch)
+                await self.rate_limiter.acquire(batch_bytes // 4 + max_output_tokens)
+            response = await self.client.aio.models.generate_content(
+                model=EXTRACTION_MODEL,
+                contents=contents,
+                config=types.GenerateContentConfig(
+                    system_instruction=EXTRACTION_PROMPT,
+                    temperature=0.7,
+                    max_output_tokens=max_output_tokens,
+                    thinking_config=types.ThinkingConfig(thinking_budget=EXTRACTION_THINKING_BUDGET),
+                    response_mime_type="application/json",
+                    response_schema=BatchedQuestionsResponse,
+                )
+            )
+            
+            parsed_response = response.parsed if hasattr(response, 'parsed') else None
+            if not parsed_response and response.text:
+                try:
+                    parsed_response = BatchedQuestionsResponse.model_validate(orjson.loads(response.text))
+                except ValueError as e:
+                    logger.warning("⚠️ Could not parse raw response: %s", e)
+            
+            if not parsed_response:
+                logger.error("❌ No parsed response available")
+                return {"error": "No parsed response available"}
+            
+            files = {pdf_path: {"totalCount": 0, "questions": []} for pdf_path, _ in pdf_batch}
+            for question in parsed_response.questions:
+                if not 1 <= question.source_file_index <= len(pdf_batch):
+                    logger.warning("⚠️ Dropping question %s with unknown source_file_index %d", question.id, question.source_file_index)
+                    continue
                 
-                # Convert to dict format for compatibility with existing code
-                questions_dict = []
-                for question in questions:
-                    question_data = question.model_dump()
-                    question_data['source_file'] = os.path.basename(pdf_path)
-                    question_data['file_index'] = file_index
-                    questions_dict.append(question_data)
+                pdf_path, file_index = pdf_batch[question.source_file_index - 1]
+                question_data = question.model_dump(exclude={'source_file_index'})
+                question_data['source_file'] = os.path.basename(pdf_path)
+                question_data['file_index'] = file_index
+                files[pdf_path]["questions"].append(question_data)
+                files[pdf_path]["totalCount"] += 1
+            
+            logger.info("✅ Extracted %d questions from a batch of %d PDFs", len(parsed_response.questions), len(pdf_batch))
+            return {"files": files}
                 
-                return {
-                    "totalCount": parsed_response.totalCount,
-                    "questions": questions_dict
-                }
+        except Exception as e:
+            logger.error("❌ Error calling Gemini API: %s", e)
+            return {"error": str(e)}
+    
+    async def run_batch_job(self, pdf_jobs, concurrency):
+        """Extract (pdf_file, file_index) pairs through one batch prediction job, returning a (pdf_file, result) pair per file"""
+        
+        semaphore = asyncio.Semaphore(concurrency)
+        
+        async def upload(pdf_file):
+            async with semaphore:
+                return await self.upload_pdf(pdf_file)
+        
+        uploads = await asyncio.gather(*(upload(f) for f, _ in pdf_jobs), return_exceptions=True)
+        results = {}
+        submitted = []
+        requests = []
+        for (pdf_file, file_index), uploaded_file in zip(pdf_jobs, uploads):
+            if isinstance(uploaded_file, Exception):
+                results[pdf_file] = {"error": f"Upload failed: {uploaded_file}"}
+                continue
+            submitted.append((pdf_file, file_index, uploaded_file))
+            requests.append(types.InlinedRequest(
+                contents=[uploaded_file, f"PDF file: {os.path.basename(pdf_file)}"],
+                config=types.GenerateContentConfig(
+                    system_instruction=EXTRACTION_PROMPT,
+                    temperature=0.7,
+                    max_output_tokens=self.output_token_limit([pdf_file]),
+                    thinking_config=types.ThinkingConfig(thinking_budget=EXTRACTION_THINKING_BUDGET),
+                    response_mime_type="application/json",
+                    response_schema=QuestionsResponse,
+                ),
+            ))
+        
+        try:
+            if requests:
+                job = await self.client.aio.batches.create(
+                    model=EXTRACTION_MODEL,
+                    src=requests,
+                    config=types.CreateBatchJobConfig(display_name='sat-question-extraction'),
+                )
+                logger.info("📦 Submitted batch job %s with %d PDFs", job.name, len(requests))
                 
-            else:
-                print("❌ No parsed response available")
-                return {"error": "No parsed response available"}
+                while job.state.name not in BATCH_DONE_STATES:
+                    await asyncio.sleep(BATCH_POLL_SECONDS)
+                    job = await self.client.aio.batches.get(name=job.name)
+                    logger.info("⏳ Batch job %s: %s", job.name, job.state.name)
                 
+                responses = job.dest.inlined_responses if job.dest else None
+                if not responses:
+                    error = f"Batch job ended in {job.state.name}: {job.error}"
+                    logger.error("❌ %s", error)
+                    for pdf_file, _, _ in submitted:
+                        results[pdf_file] = {"error": error}
+                else:
+                    # Inlined responses come back in request order
+                    for (pdf_file, file_index, _), inlined in zip(submitted, responses):
+                        if inlined.error or not inlined.response:
+                            results[pdf_file] = {"error": str(inlined.error)}
+                        else:
+                            results[pdf_file] = self.questions_result(inlined.response, pdf_file, file_index)
         except Exception as e:
-            print(f"❌ Error calling Gemini API: {e}")
-            return {"error": str(e)}
+            logger.error("❌ Batch job failed: %s", e)
+            for pdf_file, _, _ in submitted:
+                results.setdefault(pdf_file, {"error": str(e)})
+        finally:
+            for _, _, uploaded_file in submitted:
+                await self.delete_uploaded_file(uploaded_file)
+        
+        return [(pdf_file, results[pdf_file]) for pdf_file, _ in pdf_jobs]
+    
+    def batch_pdf_files(self, pdf_jobs, batch_size):
+        """Group consecutive (pdf_file, file_index) pairs into batches of at most batch_size files and BATCH_MAX_PAGES pages"""
+        
+        batches = []
+        batch = []
+        batch_pages = 0
+        for pdf_file, file_index in pdf_jobs:
+            # A PDF whose page count is unknown gets a request of its own
+            pages = self.page_counts.get(pdf_file) or BATCH_MAX_PAGES
+            if batch and (len(batch) >= batch_size or batch_pages + pages > BATCH_MAX_PAGES):
+                batches.append(batch)
+                batch = []
+                batch_pages = 0
+            batch.append((pdf_file, file_index))
+            batch_pages += pages
+        if batch:
+            batches.append(batch)
+        
+        return batches
+    
+    @staticmethod
+    def page_count(pdf_path):
+        """Number of pages in a PDF, or 0 when it cannot be opened locally"""
+        
+        import fitz  # PyMuPDF, only needed for page counts
+        
+        try:
+            with fitz.open(pdf_path) as doc:
+                return doc.page_count
+        except Exception:
+            return 0
+    
+    def count_pages(self, pdf_files):
+        """Record the page count of each PDF for sharding and output caps"""
+        
+        for pdf_file in pdf_files:
+            self.page_counts[pdf_file] = self.page_count(pdf_file)
+    
+    def write_pdf_shards(self, pdf_path, shard_pages, shard_dir):
+        """Split a PDF into files of at most shard_pages pages in shard_dir, returning their paths in page order"""
+        
+        import fitz  # PyMuPDF, only needed when sharding
+        
+        stem = os.path.splitext(os.path.basename(pdf_path))[0]
+        shard_paths = []
+        with fitz.open(pdf_path) as doc:
+            for start in range(0, doc.page_count, shard_pages):
+                end = min(start + shard_pages, doc.page_count)
+                shard_path = os.path.join(shard_dir, f"{stem}_pages_{start + 1}-{end}.pdf")
+                with fitz.open() as shard:
+                    shard.insert_pdf(doc, from_page=start, to_page=end - 1)
+                    shard.save(shard_path)
+                shard_paths.append(shard_path)
+                self.page_counts[shard_path] = end - start
+        return shard_paths
+    
+    @staticmethod
+    def has_question_markers(pdf_path):
+        """Cheap local check for answer-choice markers; PDFs without a text layer pass since they may be scans"""
+        
+        import fitz  # PyMuPDF, only needed when prefiltering
+        
+        try:
+            with fitz.open(pdf_path) as doc:
+                text = "".join(page.get_text() for page in doc)
+        except Exception as e:
+            logger.warning("⚠️ Could not read %s for prefiltering: %s", os.path.basename(pdf_path), e)
+            return True
+        
+        if not text.strip():
+            return True
+        return QUESTION_MARKER_PATTERN.search(text) is not None
     
-
     def find_similar_questions(self, questions):
         """Find similar/duplicate questions based on text content"""
         
-        print("🔍 Finding similar questions...")
+        logger.info("🔍 Finding similar questions...")
+        
+        texts = [q.get('question_text', '').lower().strip() for q in questions]
+        
+        # Identical texts are grouped directly; only the first copy of each text is compared pairwise
+        first_copy = {}
+        representatives = []
+        for i, text in enumerate(texts):
+            if not text or text not in first_copy:
+                first_copy.setdefault(text, i)
+                representatives.append(i)
+        
+        # Normalize and tokenize every question once instead of once per compared pair
+        representative_texts = [texts[i] for i in representatives]
+        word_sets = [frozenset(text.split()) for text in representative_texts]
+        similar_pairs = self.find_similar_pairs(representative_texts, word_sets)
+        
+        # Union-find makes similarity transitive: A~B and B~C put A, B and C in one group
+        parent = [first_copy[text] if text else i for i, text in enumerate(texts)]
+        
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+        
+        for a, b in similar_pairs:
+            root_i, root_j = find(representatives[a]), find(representatives[b])
+            if root_i != root_j:
+                # The lowest index stays the root so groups come out in question order
+                parent[max(root_i, root_j)] = min(root_i, root_j)
+        
+        groups = {}
+        for i in range(len(texts)):
+            groups.setdefault(find(i), []).append(i)
         
         similar_groups = []
-        processed_indices = set()
+        for similar_group in groups.values():
+            if len(similar_group) > 1:
+                logger.debug("Found similar group: %d questions", len(similar_group))
+                similar_groups.append(similar_group)
+        
+        logger.info("✅ Found %d groups of similar questions", len(similar_groups))
+        return similar_groups
+    
+    def find_similar_pairs(self, texts, word_sets):
+        """Return similar (i, j) pairs with i < j, prefiltered with numpy word-overlap counts when numpy is installed"""
+        
+        pairs = self.find_similar_pairs_numpy(texts, word_sets)
+        if pairs is not None:
+            return pairs
+        
+        pairs = []
+        for i in range(len(texts)):
+            for j in range(i + 1, len(texts)):
+                if self.are_texts_similar(texts[i], word_sets[i], texts[j], word_sets[j]):
+                    pairs.append((i, j))
+        
+        return pairs
+    
+    def find_similar_pairs_numpy(self, texts, word_sets):
+        """Count shared words for every pair with numpy and check only the pairs that can pass; None if numpy is missing"""
+        
+        try:
+            import numpy as np
+        except ImportError:
+            return None
+        
+        n = len(texts)
+        vocabulary = {}
+        word_ids = [[vocabulary.setdefault(word, len(vocabulary)) for word in words] for words in word_sets]
+        # Explicit integer dtypes keep empty input working; np.array([]) would be float64
+        lengths = np.array([len(text) for text in texts], dtype=np.int64)
+        word_counts = np.array([len(words) for words in word_sets], dtype=np.int64)
         
-        for i, q1 in enumerate(questions):
-            if i in processed_indices:
+        # Inverted index: the questions containing word w are posting_rows[posting_starts[w]:posting_starts[w + 1]]
+        flat_ids = np.fromiter((w for ids in word_ids for w in ids), dtype=np.int64, count=int(word_counts.sum()))
+        flat_rows = np.repeat(np.arange(n), word_counts)
+        posting_rows = flat_rows[np.argsort(flat_ids, kind='stable')]
+        posting_starts = np.concatenate(([0], np.cumsum(np.bincount(flat_ids, minlength=len(vocabulary)))))
+        
+        pairs = []
+        for i in range(n - 1):
+            if not texts[i] or not word_ids[i]:
                 continue
-                
-            similar_group = [i]
-            q1_text = q1.get('question_text', '').lower().strip()
             
-            # So sánh với các questions còn lại
-            for j, q2 in enumerate(questions[i+1:], i+1):
-                if j in processed_indices:
-                    continue
-                    
-                q2_text = q2.get('question_text', '').lower().strip()
-                
-                # Check similarity
-                if self.are_questions_similar(q1_text, q2_text):
-                    similar_group.append(j)
-                    processed_indices.add(j)
+            hits = np.concatenate([posting_rows[posting_starts[w]:posting_starts[w + 1]] for w in word_ids[i]])
+            overlap = np.bincount(hits[hits > i], minlength=n)[i + 1:]
+            other_lengths = lengths[i + 1:]
+            other_counts = word_counts[i + 1:]
             
-            if len(similar_group) > 1:
-                print(f"   Found similar group: {len(similar_group)} questions")
-                similar_groups.append(similar_group)
+            length_ratio = np.minimum(other_lengths, lengths[i]) / np.maximum(other_lengths, lengths[i])
+            shorter_counts = np.where(other_lengths < lengths[i], other_counts, word_counts[i])
+            
+            # Supersets of each rule in are_texts_similar; a substring shares every word of the
+            # shorter text except possibly its first and last, which may be cut mid-word
+            exact = (other_lengths == lengths[i]) & (overlap == word_counts[i])
+            substring = (other_lengths > 30) & (lengths[i] > 30) & (length_ratio > 0.8) & (overlap >= shorter_counts - 2)
+            word_overlap = (other_counts > 10) & (word_counts[i] > 10) & (overlap >= 0.7 * np.minimum(other_counts, word_counts[i]))
+            candidates = (length_ratio >= MIN_LENGTH_RATIO) & (exact | substring | word_overlap)
             
-            processed_indices.add(i)
+            for j in (np.flatnonzero(candidates) + i + 1).tolist():
+                if self.are_texts_similar(texts[i], word_sets[i], texts[j], word_sets[j]):
+                    pairs.append((i, j))
         
-        print(f"✅ Found {len(similar_groups)} groups of similar questions")
-        return similar_groups
+        return pairs
     
-    def are_questions_similar(self, text1, text2):
+    @staticmethod
+    def are_questions_similar(text1, text2):
         """Check if 2 question texts are similar (likely same question)"""
         
+        return SimplifiedBatchSATExtractor.are_texts_similar(text1, set(text1.split()), text2, set(text2.split()))
+    
+    @staticmethod
+    def are_texts_similar(text1, words1, text2, words2):
+        """Check if 2 normalized question texts, with their precomputed word sets, are similar"""
+        
         if not text1 or not text2:
             return False
         
@@ -275,20 +679,22 @@ Extract all questions and question fragments from this PDF.
         if text1 == text2:
             return True
         
+        # Cheap length gate before any substring or set work
+        len1 = len(text1)
+        len2 = len(text2)
+        length_ratio = len1 / len2 if len1 < len2 else len2 / len1
+        if length_ratio < MIN_LENGTH_RATIO:
+            return False
+        
         # One is substring of the other (likely incomplete vs complete)
-        if len(text1) > 30 and len(text2) > 30:
-            shorter = text1 if len(text1) < len(text2) else text2
-            longer = text2 if len(text1) < len(text2) else text1
-            
+        if len1 > 30 and len2 > 30:
             # If shorter is 80%+ of longer, likely same question
-            if len(shorter) / len(longer) > 0.8:
-                if shorter in longer or longer in shorter:
+            if length_ratio > 0.8:
+                shorter, longer = (text1, text2) if len1 < len2 else (text2, text1)
+                if shorter in longer:
                     return True
         
         # Check for significant overlap in words
-        words1 = set(text1.split())
-        words2 = set(text2.split())
-        
         if len(words1) > 10 and len(words2) > 10:
             overlap = len(words1.intersection(words2))
             min_words = min(len(words1), len(words2))
@@ -300,30 +706,37 @@ Extract all questions and question fragments from this PDF.
         return False
     
     def merge_incomplete_questions(self, questions):
-        """Merge consecutive questions when is_complete=false with subsequent questions until is_complete=true"""
+        """Merge consecutive questions when is_complete=false with subsequent questions until is_complete=true,
+        numbering the resulting questions sequentially as they are emitted"""
         
-        print(f"🔗 Merging incomplete questions from {len(questions)} questions...")
+        logger.debug("🔗 Merging incomplete questions from %d questions...", len(questions))
         
-        # Check how many incomplete questions we have
-        incomplete_count = sum(1 for q in questions if not q.get('is_complete', True))
-        print(f"🔍 Found {incomplete_count} incomplete questions to process")
+        # Sort questions by file_index first, then by id to ensure proper order.
+        # Every extracted question carries both keys, so a C-level itemgetter can replace the lambda.
+        questions_sorted = sorted(questions, key=itemgetter('file_index', 'id'))
+        
+        # Read the fields the sweep looks at once, up front
+        complete_flags = [q.get('is_complete', True) for q in questions_sorted]
+        texts = [q.get('question_text', '').strip() for q in questions_sorted]
+        ids = [q.get('id', '') for q in questions_sorted]
         
-        # Sort questions by file_index first, then by id to ensure proper order
-        questions_sorted = sorted(questions, key=lambda x: (x.get('file_index', 0), x.get('id', '')))
+        # Check how many incomplete questions we have
+        incomplete_count = sum(not complete for complete in complete_flags)
+        logger.info("🔍 Found %d incomplete questions to process", incomplete_count)
         
         merged = []
         i = 0
+        total = len(questions_sorted)
         
-        while i < len(questions_sorted):
+        while i < total:
             current = questions_sorted[i]
             
             # Check if current question is incomplete
-            if not current.get('is_complete', True):
-                print(f"🔍 Found incomplete question: {current.get('id')} from {current.get('source_file', 'unknown')}")
+            if not complete_flags[i]:
+                logger.debug("Found incomplete question %s from %s", ids[i], current.get('source_file', 'unknown'))
                 
                 # Start merging - collect all consecutive questions until we find a complete one
-                merged_question_text = current.get('question_text', '').strip()
-                merged_id = current.get('id')
+                text_parts = [texts[i]]
                 merged_answer = current.get('correct_answer')
                 merged_options = current.get('options', [])
                 merged_explanation = current.get('explanation', '')
@@ -332,44 +745,36 @@ Extract all questions and question fragments from this PDF.
                 
                 # Look ahead for continuation
                 j = i + 1
-                merged_count = 1
                 
-                while j < len(questions_sorted):
+                while j < total:
                     next_q = questions_sorted[j]
-                    next_text = next_q.get('question_text', '').strip()
-                    next_complete = next_q.get('is_complete', True)
-                    next_id = next_q.get('id', '')
+                    next_complete = complete_flags[j]
                     
-                    print(f"   Checking next question {next_id}: complete={next_complete}")
+                    logger.debug("Checking next question %s: complete=%s", ids[j], next_complete)
                     
-                    # Add the next question text
-                    if merged_question_text and not merged_question_text.endswith(' '):
-                        merged_question_text += ' '
-                    merged_question_text += next_text
+                    text_parts.append(texts[j])
                     
                     # Use options from complete question if available
                     if next_complete and len(next_q.get('options', [])) == 4:
-                        merged_options = next_q.get('options', [])
+                        merged_options = next_q['options']
                         merged_answer = next_q.get('correct_answer', merged_answer)
                         merged_explanation = next_q.get('explanation', merged_explanation)
                     
                     source_files.append(next_q.get('source_file', ''))
-                    merged_notes.append(f"Merged with {next_id}")
-                    merged_count += 1
-                    
-                    print(f"     ✅ Merged question from {next_id}")
+                    merged_notes.append(f"Merged with {ids[j]}")
                     
                     # If this question is complete, we're done merging
                     if next_complete:
-                        print(f"   ✅ Found complete question, finished merging {merged_count} parts")
                         break
                     
                     j += 1
                 
+                merged_count = len(text_parts)
+                
                 # Create merged question
                 merged_question = {
-                    'id': merged_id,
-                    'question_text': merged_question_text,
+                    'id': f"q_{len(merged) + 1:03d}",
+                    'question_text': ' '.join(filter(None, text_parts)),
                     'options': merged_options,
                     'correct_answer': merged_answer,
                     'explanation': merged_explanation,
@@ -388,191 +793,273 @@ Extract all questions and question fragments from this PDF.
                     merged_question['notes'] = f"Merged {merged_count} questions: " + '; '.join(merged_notes)
                 
                 merged.append(merged_question)
-                print(f"   ✅ Created merged question from {merged_count} parts")
+                logger.debug("Created merged question %s from %d parts", ids[i], merged_count)
                 
                 # Skip all the questions we just merged
                 i = j + 1
                         
             else:
                 # Complete question, add as-is
+                current['id'] = f"q_{len(merged) + 1:03d}"
                 merged.append(current)
                 i += 1
         
-        print(f"📊 After merging incomplete: {len(questions)} → {len(merged)} questions")
+        logger.info("📊 After merging incomplete: %d → %d questions", len(questions), len(merged))
         return merged
     
     def remove_duplicates(self, questions):
         """Remove duplicate questions, keeping the longest version"""
         
-        print(f"🧹 Removing duplicates from {len(questions)} questions...")
+        logger.info("🧹 Removing duplicates from %d questions...", len(questions))
         
         # Find similar question groups
         similar_groups = self.find_similar_questions(questions)
         
-        # Track which questions to keep
-        questions_to_keep = []
-        questions_to_remove = set()
-        
         # For each group of similar questions, keep the longest one
+        questions_to_remove = set()
         for group_indices in similar_groups:
-            group_questions = [questions[i] for i in group_indices]
+            longest_index = max(group_indices, key=lambda i: len(questions[i].get('question_text', '')))
+            max_length = len(questions[longest_index].get('question_text', ''))
+            logger.debug("Selected question %d of %d (longest: %d chars)", longest_index, len(group_indices), max_length)
             
-            # Find the longest question text in this group
-            longest_question = None
-            longest_index = -1
-            max_length = 0
-            
-            for i, question in enumerate(group_questions):
-                question_length = len(question.get('question_text', ''))
-                print(f"   Question {group_indices[i]}: length={question_length}")
-                
-                if question_length > max_length:
-                    max_length = question_length
-                    longest_question = question
-                    longest_index = group_indices[i]
-            
-            print(f"   ✅ Selected question {longest_index} (longest: {max_length} chars)")
-            
-            # Mark others for removal
-            for j in group_indices:
-                if j != longest_index:
-                    questions_to_remove.add(j)
+            questions_to_remove.update(i for i in group_indices if i != longest_index)
         
         # Keep questions that are not duplicates + longest questions from duplicate groups
-        for i, question in enumerate(questions):
-            if i not in questions_to_remove:
-                questions_to_keep.append(question)
+        questions_to_keep = [question for i, question in enumerate(questions) if i not in questions_to_remove]
         
-        print(f"📊 After removing duplicates: {len(questions)} → {len(questions_to_keep)} questions")
+        logger.info("📊 After removing duplicates: %d → %d questions", len(questions), len(questions_to_keep))
         return questions_to_keep
     
-    def reassign_question_ids(self, questions):
-        """Reassign sequential question IDs"""
+    async def extract_file(self, pdf_batch, semaphore):
+        """Extract one batch of PDFs once a request slot is free, returning a (pdf_file, result) pair per file"""
+        
+        try:
+            async with semaphore:
+                result = await self.extract_with_retry(pdf_batch)
+        except Exception as e:
+            logger.error("❌ Exception processing %s: %s", ', '.join(os.path.basename(p) for p, _ in pdf_batch), e)
+            result = {"error": str(e)}
+        
+        if 'files' in result:
+            return list(result['files'].items())
+        return [(pdf_file, result) for pdf_file, _ in pdf_batch]
+    
+    async def extract_sharded_file(self, pdf_file, file_index, shard_pages, semaphore):
+        """Extract a long PDF as concurrent page-range requests, returning one (pdf_file, result) pair for the whole file"""
+        
+        with tempfile.TemporaryDirectory() as shard_dir:
+            shard_paths = await asyncio.to_thread(self.write_pdf_shards, pdf_file, shard_pages, shard_dir)
+            logger.info("✂️ Split %s into %d shards of up to %d pages", os.path.basename(pdf_file), len(shard_paths), shard_pages)
+            shard_results = await asyncio.gather(*(
+                self.extract_file([(shard_path, file_index)], semaphore) for shard_path in shard_paths
+            ))
+        
+        questions = []
+        for [(_, result)] in shard_results:
+            if 'questions' not in result:
+                return [(pdf_file, result)]
+            questions.extend(result['questions'])
+        
+        # Every shard numbers its questions from q_001; renumber so page order survives the merge sort
+        for n, question_data in enumerate(questions, 1):
+            question_data['id'] = f"q_{n:03d}"
+            question_data['source_file'] = os.path.basename(pdf_file)
+        
+        return [(pdf_file, {"totalCount": len(questions), "questions": questions})]
+    
+    async def extract_files(self, pdf_files, concurrency, staging, batch_size=1, batch_api=False, shard_pages=0):
+        """Extract all PDFs on one event loop, streaming each result to the staging file as it completes"""
+        
+        question_count = 0
+        successful_files = []
+        failed_files = []
+        
+        # PDFs answered in an earlier run come straight from the cache
+        cached_results = []
+        cache_files = {}
+        pdf_jobs = []
+        for file_index, pdf_file in enumerate(pdf_files, 1):
+            if self.result_cache:
+                cache_file = self.result_cache.path(file_content_hash(pdf_file))
+                cached_result = self.result_cache.load(cache_file, os.path.basename(pdf_file), file_index)
+                if cached_result:
+                    logger.info("💾 Cache hit for %s", os.path.basename(pdf_file))
+                    cached_results.append((pdf_file, cached_result))
+                    continue
+                cache_files[pdf_file] = cache_file
+            pdf_jobs.append((pdf_file, file_index))
+        
+        async def from_cache():
+            return cached_results
+        
+        # Counting pages opens every PDF, so keep it off the event loop
+        await asyncio.to_thread(self.count_pages, [pdf_file for pdf_file, _ in pdf_jobs])
+        
+        semaphore = asyncio.Semaphore(concurrency)
+        tasks = [from_cache()]
+        if batch_api:
+            if pdf_jobs:
+                tasks.append(self.run_batch_job(pdf_jobs, concurrency))
+        else:
+            if shard_pages:
+                long_jobs = [job for job in pdf_jobs if self.page_counts[job[0]] > shard_pages]
+                tasks.extend(
+                    self.extract_sharded_file(pdf_file, file_index, shard_pages, semaphore)
+                    for pdf_file, file_index in long_jobs
+                )
+                pdf_jobs = [job for job in pdf_jobs if job not in long_jobs]
+            tasks.extend(
+                self.extract_file(pdf_batch, semaphore)
+                for pdf_batch in self.batch_pdf_files(pdf_jobs, batch_size)
+            )
+        
+        # Process completed tasks
+        completed_count = 0
+        for next_completed in asyncio.as_completed(tasks):
+            for pdf_file, result in await next_completed:
+                completed_count += 1
+                
+                if result and 'questions' in result:
+                    questions = result['questions']
+                    if questions:
+                        for question in questions:
+                            staging.write(orjson.dumps(question) + b'\n')
+                        staging.flush()
+                        if pdf_file in cache_files:
+                            self.result_cache.save(cache_files[pdf_file], result)
+                        question_count += len(questions)
+                        successful_files.append(pdf_file)
+                        logger.debug("📝 Sample from %s: %s...", os.path.basename(pdf_file), questions[0].get('question_text', '')[:100])
+                    else:
+                        logger.error("❌ FAILED: %s: No questions extracted", os.path.basename(pdf_file))
+                        failed_files.append(pdf_file)
+                else:
+                    failed_files.append(pdf_file)
+                    logger.error("❌ FAILED: %s: %s", os.path.basename(pdf_file), (result or {}).get('error', 'unknown error'))
+                
+                logger.info("📊 Completed %d/%d files, %d questions so far", completed_count, len(pdf_files), question_count)
+        
+        return successful_files, failed_files
+    
+    def write_result(self, output_file, questions, metadata):
+        """Write the final JSON one question at a time instead of serializing the whole result at once"""
         
-        print("🔢 Reassigning question IDs sequentially...")
+        with open(output_file, 'wb') as f:
+            f.write(b'{"totalCount": %d, "questions": [' % len(questions))
+            for i, question in enumerate(questions):
+                if i:
+                    f.write(b', ')
+                f.write(orjson.dumps(question))
+            f.write(b'], "metadata": ')
+            f.write(orjson.dumps(metadata))
+            f.write(b'}')
+    
+    def write_ndjson_result(self, output_file, questions, metadata):
+        """Write one question per line, with the count and metadata in a separate manifest file"""
         
-        for i, question in enumerate(questions, 1):
-            question['id'] = f"q_{i:03d}"
+        with open(output_file, 'wb') as f:
+            for question in questions:
+                f.write(orjson.dumps(question) + b'\n')
         
-        return questions
+        with open(output_file + '.meta.json', 'wb') as f:
+            f.write(orjson.dumps({"totalCount": len(questions), "metadata": metadata}))
     
-    def process_directory(self, input_dir, output_file="batch_questions_simplified.json", max_files=None, parallel=True):
+    def process_directory(self, input_dir, output_file="batch_questions_simplified.json", max_files=None, parallel=True,
+                          requests_per_minute=DEFAULT_REQUESTS_PER_MINUTE, tokens_per_minute=DEFAULT_TOKENS_PER_MINUTE,
+                          batch_size=1, prefilter=False, workers=DEFAULT_WORKERS, batch_api=False, ndjson=False,
+                          cache_dir=DEFAULT_CACHE_DIR, shard_pages=DEFAULT_SHARD_PAGES):
         """Process all PDF files in directory"""
         
-        print(f"🔄 SIMPLIFIED BATCH QUESTION EXTRACTION")
-        print(f"📁 Input directory: {input_dir}")
-        print(f"📄 Output file: {output_file}")
-        print(f"⚡ Processing mode: {'Parallel' if parallel else 'Sequential'}")
+        logger.info("🔄 SIMPLIFIED BATCH QUESTION EXTRACTION")
+        logger.info("📁 Input directory: %s", input_dir)
+        logger.info("📄 Output file: %s", output_file)
+        logger.info("⚡ Processing mode: %s", 'Parallel' if parallel else 'Sequential')
         
-        # Find all PDF files
+        # Find all PDF files, sorted to ensure order
         pdf_files = []
         if os.path.exists(input_dir):
-            for file in os.listdir(input_dir):
-                if file.lower().endswith('.pdf'):
-                    pdf_files.append(os.path.join(input_dir, file))
+            with os.scandir(input_dir) as entries:
+                pdf_files = sorted(
+                    entry.path for entry in entries
+                    if entry.is_file() and entry.name.lower().endswith('.pdf')
+                )
         
         if not pdf_files:
-            print(f"❌ No PDF files found in {input_dir}")
+            logger.error("❌ No PDF files found in %s", input_dir)
             return
         
-        # Sort files to ensure order
-        pdf_files.sort()
-        
         # Limit files if max_files is specified
         if max_files and max_files > 0:
             pdf_files = pdf_files[:max_files]
-            print(f"📊 Found {len(pdf_files)} PDF files (limited to first {max_files})")
+            logger.info("📊 Found %d PDF files (limited to first %d)", len(pdf_files), max_files)
         else:
-            print(f"📊 Found {len(pdf_files)} PDF files")
+            logger.info("📊 Found %d PDF files", len(pdf_files))
         
-        # Process each file
-        all_questions = []
-        successful_files = []
-        failed_files = []
+        skipped_files = []
+        if prefilter:
+            candidate_files = []
+            for pdf_file in pdf_files:
+                if self.has_question_markers(pdf_file):
+                    candidate_files.append(pdf_file)
+                else:
+                    logger.info("⏭️ Skipping %s: no answer choice markers", os.path.basename(pdf_file))
+                    skipped_files.append(pdf_file)
+            pdf_files = candidate_files
+            if not pdf_files:
+                logger.error("❌ No PDF files with questions found in %s", input_dir)
+                return
+        
+        # Process each file; long PDFs fan out into several shard requests, so the limit is not tied to the file count
+        concurrency = max(1, workers) if parallel else 1
+        self.rate_limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+        self.result_cache = ResultCache(cache_dir, PROMPT_VERSION, 'questions', ('totalCount',)) if cache_dir else None
+        logger.info("🚀 Starting %s processing with %d concurrent requests...", 'parallel' if parallel else 'sequential', concurrency)
+        
+        # Questions are staged as JSON lines while extraction runs, then read back for merging
+        staging_file = output_file + '.jsonl'
+        try:
+            with open(staging_file, 'wb') as staging:
+                successful_files, failed_files = asyncio.run(self.extract_files(pdf_files, concurrency, staging, batch_size, batch_api, shard_pages))
+            
+            with open(staging_file, 'rb') as staging:
+                all_questions = [orjson.loads(line) for line in staging]
+        finally:
+            # Everything needed is in memory once read back, so the staging file never outlives the run
+            if os.path.exists(staging_file):
+                os.remove(staging_file)
         
-        if parallel:
-            with ThreadPoolExecutor(max_workers=min(4, len(pdf_files))) as executor:
-                future_to_file = {}
-                for i, pdf_file in enumerate(pdf_files, 1):
-                    future = executor.submit(self.extract_with_retry, pdf_file, i)
-                    future_to_file[future] = (pdf_file, i)
-                
-                # Process completed tasks
-                completed_count = 0
-                for future in as_completed(future_to_file):
-                    pdf_file, file_index = future_to_file[future]
-                    completed_count += 1
-                    
-                    print(f"\n{'='*60}")
-                    print(f"COMPLETED FILE {completed_count}/{len(pdf_files)}: {os.path.basename(pdf_file)}")
-                    print(f"{'='*60}")
-                    
-                    try:
-                        result = future.result()
-                        
-                        if result and 'questions' in result:
-                            questions = result['questions']
-                            if questions:
-                                with self.lock:  # Thread-safe access
-                                    all_questions.extend(questions)
-                                    successful_files.append(pdf_file)
-                                print(f"✅ SUCCESS: {len(questions)} questions extracted")
-                                
-                                # Show sample
-                                if questions:
-                                    sample = questions[0]
-                                    print(f"📝 Sample - Question: {sample.get('question_text', '')[:100]}...")
-                            else:
-                                print(f"❌ FAILED: No questions extracted")
-                                with self.lock:
-                                    failed_files.append(pdf_file)
-                        else:
-                            print(f"❌ FAILED: Error processing file")
-                            with self.lock:
-                                failed_files.append(pdf_file)
-                            if result and 'error' in result:
-                                print(f"🐛 Error: {result['error']}")
-                        
-                        # Show progress
-                        with self.lock:
-                            print(f"📊 Total questions so far: {len(all_questions)}")
-                            
-                    except Exception as e:
-                        print(f"❌ Exception processing {os.path.basename(pdf_file)}: {e}")
-                        with self.lock:
-                            failed_files.append(pdf_file)
         if not all_questions:
-            print("❌ No questions extracted from any file!")
+            logger.error("❌ No questions extracted from any file!")
             return
         
-        merged_questions = self.merge_incomplete_questions(all_questions)
-        final_questions = self.reassign_question_ids(merged_questions)
+        # Merging also assigns the final sequential IDs
+        final_questions = self.merge_incomplete_questions(all_questions)
         
         # Create final result
-        final_result = {
-            "totalCount": len(final_questions),
-            "questions": final_questions,
-            "metadata": {
-                "total_files_processed": len(pdf_files),
-                "total_files_successful": len(successful_files),
-                "total_files_failed": len(failed_files),
-                "total_raw_questions": len(all_questions),
-                "total_unique_questions": len(final_questions),
-                "extraction_date": time.strftime('%Y-%m-%d %H:%M:%S'),
-                "extraction_method": "simplified_batch",
-                "model_used": "gemini-2.5-flash-preview-05-20"
-            }
+        metadata = {
+            "total_files_processed": len(pdf_files),
+            "total_files_successful": len(successful_files),
+            "total_files_failed": len(failed_files),
+            "total_raw_questions": len(all_questions),
+            "total_unique_questions": len(final_questions),
+            "extraction_date": time.strftime('%Y-%m-%d %H:%M:%S'),
+            "extraction_method": "simplified_batch",
+            "model_used": EXTRACTION_MODEL
         }
         
         if successful_files:
-            final_result["metadata"]["successful_files"] = [os.path.basename(f) for f in successful_files]
+            metadata["successful_files"] = [os.path.basename(f) for f in successful_files]
         if failed_files:
-            final_result["metadata"]["failed_files"] = [os.path.basename(f) for f in failed_files]
+            metadata["failed_files"] = [os.path.basename(f) for f in failed_files]
+        if skipped_files:
+            metadata["skipped_files"] = [os.path.basename(f) for f in skipped_files]
         
         # Save results  
         try:
-            with open(output_file, 'w', encoding='utf-8') as f:
-                json.dump(final_result, f, ensure_ascii=False, indent=2)
+            if ndjson:
+                self.write_ndjson_result(output_file, final_questions, metadata)
+            else:
+                self.write_result(output_file, final_questions, metadata)
             
             
             if final_questions:
@@ -580,21 +1067,21 @@ Extract all questions and question fragments from this PDF.
                 math_count = sum(1 for q in final_questions if q.get('question_type') == 'math')
                 reading_count = sum(1 for q in final_questions if q.get('question_type') == 'reading_and_writing')
                 
-                print(f"\n📈 Question type distribution:")
-                print(f"   - Math: {math_count} questions")
-                print(f"   - Reading and writing: {reading_count} questions")
-                print(f"   - Other: {len(final_questions) - math_count - reading_count} questions")
+                logger.info("📈 Question type distribution:")
+                logger.info("   - Math: %d questions", math_count)
+                logger.info("   - Reading and writing: %d questions", reading_count)
+                logger.info("   - Other: %d questions", len(final_questions) - math_count - reading_count)
                 
-                print(f"\n📝 Sample question:")
+                logger.info("📝 Sample question:")
                 sample = final_questions[0]
-                print(f"   ID: {sample.get('id', 'N/A')}")
-                print(f"   Type: {sample.get('question_type', 'N/A')}")
-                print(f"   Question: {sample.get('question_text', '')[:150]}...")
-                print(f"   Options: {len(sample.get('options', []))}")
-                print(f"   Answer: {sample.get('correct_answer', 'N/A')}")
+                logger.info("   ID: %s", sample.get('id', 'N/A'))
+                logger.info("   Type: %s", sample.get('question_type', 'N/A'))
+                logger.info("   Question: %s...", sample.get('question_text', '')[:150])
+                logger.info("   Options: %d", len(sample.get('options', [])))
+                logger.info("   Answer: %s", sample.get('correct_answer', 'N/A'))
                 
         except Exception as e:
-            print(f"❌ Failed to save results: {e}")
+            logger.error("❌ Failed to save results: %s", e)
 
 def main():
     """Main function"""
@@ -606,9 +1093,23 @@ def main():
     parser.add_argument('--max-files', type=int, default=None, help='Maximum number of files to process (for testing)')
     parser.add_argument('--parallel', action='store_true', default=True, help='Use parallel processing (default)')
     parser.add_argument('--sequential', action='store_true', help='Use sequential processing instead of parallel')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help='Number of concurrent extraction requests')
+    parser.add_argument('--rpm', type=int, default=DEFAULT_REQUESTS_PER_MINUTE, help='Requests per minute allowed by your API tier')
+    parser.add_argument('--tpm', type=int, default=DEFAULT_TOKENS_PER_MINUTE, help='Tokens per minute allowed by your API tier')
+    parser.add_argument('--batch-size', type=int, default=1, help='Send up to this many consecutive small PDFs per request (default: 1)')
+    parser.add_argument('--shard-pages', type=int, default=DEFAULT_SHARD_PAGES, help='Split PDFs longer than this many pages into concurrent requests (0 disables)')
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR, help='Directory for cached responses, keyed by PDF content')
+    parser.add_argument('--no-cache', action='store_true', help='Always call the API, ignoring and not writing the cache')
+    parser.add_argument('--ndjson', action='store_true', help='Write one question per line, with metadata in OUTPUT.meta.json')
+    parser.add_argument('--batch-api', action='store_true', help='Submit all PDFs as one Gemini batch job (half price, may take hours)')
+    parser.add_argument('--prefilter', action='store_true', help='Skip PDFs whose text has no answer choice markers without calling Gemini')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Log progress for every merged question')
     
     args = parser.parse_args()
     
+    level = 'DEBUG' if args.verbose else os.getenv('LOG_LEVEL', 'INFO').upper()
+    logging.basicConfig(stream=sys.stdout, level=level, format='%(asctime)s %(message)s')
+    
     if not os.path.exists(args.input_dir):
         print(f"❌ Directory not found: {args.input_dir}")
         return
@@ -618,7 +1119,11 @@ def main():
     
     try:
         extractor = SimplifiedBatchSATExtractor()
-        extractor.process_directory(args.input_dir, args.output, max_files=args.max_files, parallel=parallel_mode)
+        extractor.process_directory(args.input_dir, args.output, max_files=args.max_files, parallel=parallel_mode,
+                                    requests_per_minute=args.rpm, tokens_per_minute=args.tpm,
+                                    batch_size=args.batch_size, prefilter=args.prefilter, workers=args.workers,
+                                    batch_api=args.batch_api, ndjson=args.ndjson, shard_pages=args.shard_pages,
+                                    cache_dir=None if args.no_cache else args.cache_dir)
         
     except Exception as e:
         print(f"❌ Error: {e}")
@@ -0,0 +1,161 @@
+"""
+Shared Gemini helpers for the batch extractors: error classification, rate limiting,
+content hashing, Files API uploads and the per-PDF result cache
+"""
+
+import os
+import orjson
+import hashlib
+import mmap
+import re
+import time
+import asyncio
+import logging
+from google.genai import types
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_PATTERN = re.compile(r'\b(429|quota|rate.?limit|resource_exhausted)\b', re.IGNORECASE)
+CLIENT_ERROR_PATTERN = re.compile(r'\b4\d\d\b')
+
+def is_retryable_error(message):
+    """Rate limits, server and network errors are worth retrying; other 4xx errors are not"""
+    if RATE_LIMIT_PATTERN.search(message):
+        return True
+    return not CLIENT_ERROR_PATTERN.search(message)
+
+class RateLimiter:
+    """Token bucket that paces requests and tokens per minute across all concurrent extractions"""
+    
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.capacity_factor = 1.0
+        self.available_request_capacity = requests_per_minute
+        self.available_token_capacity = tokens_per_minute
+        self.last_update = time.monotonic()
+    
+    def _refill(self):
+        """Top up both buckets for the time elapsed since the last update"""
+        now = time.monotonic()
+        elapsed = now - self.last_update
+        self.last_update = now
+        
+        max_requests = self.requests_per_minute * self.capacity_factor
+        max_tokens = self.tokens_per_minute * self.capacity_factor
+        self.available_request_capacity = min(max_requests, self.available_request_capacity + max_requests * elapsed / 60)
+        self.available_token_capacity = min(max_tokens, self.available_token_capacity + max_tokens * elapsed / 60)
+    
+    async def acquire(self, estimated_tokens):
+        """Wait until there is capacity for one request of the estimated size, then consume it"""
+        while True:
+            self._refill()
+            max_requests = self.requests_per_minute * self.capacity_factor
+            max_tokens = self.tokens_per_minute * self.capacity_factor
+            
+            # A request larger than the whole bucket only has to wait for a full bucket
+            tokens = min(estimated_tokens, max_tokens)
+            if self.available_request_capacity >= 1 and self.available_token_capacity >= tokens:
+                self.available_request_capacity -= 1
+                self.available_token_capacity -= tokens
+                return
+            
+            wait_time = max(
+                (1 - self.available_request_capacity) * 60 / max_requests,
+                (tokens - self.available_token_capacity) * 60 / max_tokens,
+                0.05,
+            )
+            await asyncio.sleep(wait_time)
+    
+    def throttle(self):
+        """Halve the budget after the API reports a rate limit"""
+        if self.capacity_factor == 1.0:
+            logger.warning("🚦 Rate limited, halving request budget")
+        self.capacity_factor = 0.5
+        self._refill()
+    
+    def restore(self):
+        """Return to the full budget after a successful request"""
+        self.capacity_factor = 1.0
+
+def file_content_hash(path):
+    """SHA-256 hex digest of a file's content"""
+    
+    # Hash straight from the page cache instead of copying the file through read() buffers
+    with open(path, 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            return hashlib.sha256().hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return hashlib.sha256(mapped).hexdigest()
+
+async def upload_pdf(client, pdf_path):
+    """Upload PDF to the Gemini Files API so generation requests only carry a file reference"""
+    
+    return await client.aio.files.upload(
+        file=pdf_path,
+        config=types.UploadFileConfig(mime_type='application/pdf'),
+    )
+
+async def delete_uploaded_file(client, uploaded_file):
+    """Remove an uploaded PDF from the Files API, ignoring failures"""
+    
+    try:
+        await client.aio.files.delete(name=uploaded_file.name)
+    except Exception as e:
+        logger.warning("⚠️ Could not delete uploaded file %s: %s", uploaded_file.name, e)
+
+def attribute_items(result, items_key, source_file, file_index):
+    """Copy a result with every item under items_key attributed to the given PDF name and merge position"""
+    
+    items = [dict(item, source_file=source_file, file_index=file_index) for item in result[items_key]]
+    return dict(result, **{items_key: items})
+
+class ResultCache:
+    """Per-PDF extraction results on disk, keyed by content hash and prompt version"""
+    
+    def __init__(self, cache_dir, prompt_version, items_key, fields=()):
+        self.cache_dir = cache_dir
+        self.prompt_version = prompt_version
+        # The list of extracted items, and the other result fields stored alongside it
+        self.items_key = items_key
+        self.fields = fields
+    
+    def path(self, content_hash):
+        """Cache file for a PDF with this content hash"""
+        return os.path.join(self.cache_dir, f"{content_hash[:16]}_{self.prompt_version}.json")
+    
+    def load(self, cache_file, source_file, file_index):
+        """Return the cached result attributed to this PDF, or None on a miss"""
+        
+        try:
+            with open(cache_file, 'rb') as f:
+                cached = orjson.loads(f.read())
+        except (OSError, ValueError):
+            return None
+        
+        if cached.get('prompt_version') != self.prompt_version:
+            return None
+        
+        # The same content may sit under another name or position in this run
+        result = {field: cached.get(field) for field in self.fields}
+        result[self.items_key] = cached[self.items_key]
+        return attribute_items(result, self.items_key, source_file, file_index)
+    
+    def save(self, cache_file, result):
+        """Write an extraction result to the cache atomically, without its per-run attribution"""
+        
+        cached = {"prompt_version": self.prompt_version}
+        cached.update((field, result.get(field)) for field in self.fields)
+        cached[self.items_key] = [
+            {key: value for key, value in item.items() if key not in ('source_file', 'file_index')}
+            for item in result[self.items_key]
+        ]
+        
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+            with open(tmp_file, 'wb') as f:
+                f.write(orjson.dumps(cached))
+            os.replace(tmp_file, cache_file)
+        except OSError as e:
+            logger.warning("⚠️ Could not write cache file %s: %s", cache_file, e)
@@ -5,8 +5,17 @@ Combine extracted explanations into questions file following data_formatted.json
 """
 
 import os
-import json
-import time
+import mmap
+import orjson
+from datetime import datetime, timezone
+
+def load_json_file(path):
+    """Parse a JSON file straight from a read-only memory map instead of copying it into a bytes object"""
+    with open(path, 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            return orjson.loads(f.read())  # empty files cannot be mapped; let orjson report the error
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped, memoryview(mapped) as view:
+            return orjson.loads(view)
 
 class QuestionExplanationMerger:
     def __init__(self):
@@ -15,8 +24,7 @@ class QuestionExplanationMerger:
     def load_questions(self, questions_file):
         """Load questions file"""
         try:
-            with open(questions_file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
+            data = load_json_file(questions_file)
             
             questions = data.get('questions', [])
             print(f"📊 Loaded {len(questions)} questions from {questions_file}")
@@ -27,30 +35,29 @@ class QuestionExplanationMerger:
             return None, None
     
     def load_explanations(self, explanations_file):
-        """Load explanations file"""
+        """Yield explanations one at a time, streaming the file when ijson is installed"""
         try:
-            with open(explanations_file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-            
-            explanations = data.get('explanations', [])
-            print(f"📊 Loaded {len(explanations)} explanations from {explanations_file}")
-            return explanations
-            
-        except Exception as e:
-            print(f"❌ Error reading explanations file: {e}")
-            return None
+            import ijson  # optional, avoids holding the whole file in memory
+        except ImportError:
+            yield from load_json_file(explanations_file).get('explanations', [])
+            return
+        
+        with open(explanations_file, 'rb') as f:
+            yield from ijson.items(f, 'explanations.item', use_float=True)
     
     def create_explanation_mapping(self, explanations):
-        """Create mapping from ID to explanation"""
+        """Create mapping from ID to explanation, returning it with the number of explanations read"""
         mapping = {}
+        total = 0
         
         for exp in explanations:
+            total += 1
             exp_id = exp.get('id', '')
             if exp_id:
                 mapping[exp_id] = exp
         
-        print(f"📊 Created mapping for {len(mapping)} explanations")
-        return mapping
+        print(f"📊 Created mapping for {len(mapping)} of {total} explanations")
+        return mapping, total
     
     def transform_question_format(self, question, explanation_data=None):
         """Transform question to data_formatted.json format"""
@@ -95,50 +102,76 @@ class QuestionExplanationMerger:
         
         return transformed_question
     
-    def merge_explanations_into_questions(self, questions_data, questions, explanations):
-        """Merge explanations into questions following data_formatted.json format"""
+    def merge_explanations_into_questions(self, questions, explanation_mapping, stats, samples):
+        """Yield questions in data_formatted.json format with explanations merged in, counting into stats as they go"""
         
-        # Create mapping
-        explanation_mapping = self.create_explanation_mapping(explanations)
-        
-        matched_count = 0
-        transformed_questions = []
+        unmatched_ids = []
         
         for question in questions:
             question_id = question.get('id', '')
-            explanation_data = None
+            explanation_data = explanation_mapping.get(question_id)
             
-            if question_id in explanation_mapping:
-                explanation_data = explanation_mapping[question_id]
-                matched_count += 1
-                print(f"✅ Matched explanation for {question_id}")
+            if explanation_data is not None:
+                stats['matched'] += 1
             else:
-                print(f"❌ No explanation found for {question_id}")
+                unmatched_ids.append(question_id)
             
             # Transform question to new format
             transformed_question = self.transform_question_format(question, explanation_data)
-            transformed_questions.append(transformed_question)
+            
+            stats['total'] += 1
+            question_type = transformed_question['type']
+            if question_type == 'math':
+                stats['math'] += 1
+            elif question_type == 'reading_and_writing':
+                stats['reading'] += 1
+            if 'fields_by_ai_gen' in transformed_question:
+                stats['ai'] += 1
+            if 'question_page' in transformed_question:
+                stats['page'] += 1
+            if transformed_question['explanation'] and len(samples) < 2:
+                samples.append(transformed_question)
+            
+            yield transformed_question
         
-        print(f"📊 Matched {matched_count}/{len(questions)} explanations")
+        print(f"📊 Matched {stats['matched']}/{stats['total']} explanations")
+        if unmatched_ids:
+            print(f"❌ No explanation found for {len(unmatched_ids)} questions: {', '.join(unmatched_ids[:5])}{', ...' if len(unmatched_ids) > 5 else ''}")
+    
+    def write_result(self, output_file, questions, build_metadata, pretty=False):
+        """Write the merged JSON one question at a time, compact unless pretty is set
         
-        # Create new data structure following data_formatted.json format
-        merged_data = {
-            "questions": transformed_questions,
-            "metadata": {
-                "total_questions": len(transformed_questions),
-                "explanations_merged": True,
-                "explanations_matched": matched_count,
-                "explanations_total": len(explanations),
-                "merge_date": time.strftime('%Y-%m-%d %H:%M:%S'),
-                "format_version": "data_formatted_compatible",
-                "original_questions_metadata": questions_data.get('metadata', {})
-            }
-        }
+        build_metadata is called once every question has been written, so it can report final counts.
+        Pretty output has the same 2-space layout as a single indented dump.
+        """
+        
+        option = orjson.OPT_INDENT_2 if pretty else None
+        newline = b'\n' if pretty else b''
+        question_indent = newline + b'    ' if pretty else b''
+        field_indent = newline + b'  ' if pretty else b''
+        colon = b': ' if pretty else b':'
         
-        return merged_data, matched_count
+        def dump(value, indent):
+            # JSON strings escape newlines, so every newline in a dump is indentation
+            return orjson.dumps(value, option=option).replace(b'\n', indent)
+        
+        with open(output_file, 'wb') as f:
+            f.write(b'{' + field_indent + b'"questions"' + colon + b'[')
+            wrote_questions = False
+            for question in questions:
+                if wrote_questions:
+                    f.write(b',')
+                f.write(question_indent + dump(question, question_indent))
+                wrote_questions = True
+            if wrote_questions:
+                f.write(field_indent)
+            f.write(b'],' + field_indent + b'"metadata"' + colon)
+            metadata = build_metadata()
+            f.write(dump(metadata, field_indent) + newline + b'}')
+        return metadata
     
-    def merge_files(self, questions_file, explanations_file, output_file):
-        """Merge two files and save result in data_formatted.json format"""
+    def merge_files(self, questions_file, explanations_file, output_file, pretty=False):
+        """Merge two files and save result in data_formatted.json format, returning the output metadata"""
         
         print("🔄 MERGE QUESTIONS WITH EXPLANATIONS (DATA_FORMATTED FORMAT)")
         print("=" * 60)
@@ -152,52 +185,58 @@ class QuestionExplanationMerger:
         if not questions:
             return None
         
-        # Load explanations
-        explanations = self.load_explanations(explanations_file)
-        if not explanations:
+        # Load explanations straight into the ID mapping
+        try:
+            explanation_mapping, explanations_total = self.create_explanation_mapping(
+                self.load_explanations(explanations_file)
+            )
+        except Exception as e:
+            print(f"❌ Error reading explanations file: {e}")
             return None
         
-        # Merge
-        merged_data, matched_count = self.merge_explanations_into_questions(
-            questions_data, questions, explanations
-        )
+        print(f"📊 Loaded {explanations_total} explanations from {explanations_file}")
+        if not explanations_total:
+            return None
+        
+        # Questions are merged as they are written, so the merged list never exists in memory
+        merge_date = datetime.now(timezone.utc).isoformat(timespec='seconds')
+        stats = {'total': 0, 'matched': 0, 'math': 0, 'reading': 0, 'ai': 0, 'page': 0}
+        samples = []
+        merged_questions = self.merge_explanations_into_questions(questions, explanation_mapping, stats, samples)
+        
+        def build_metadata():
+            return {
+                "total_questions": stats['total'],
+                "explanations_merged": True,
+                "explanations_matched": stats['matched'],
+                "explanations_total": explanations_total,
+                "merge_date": merge_date,
+                "format_version": "data_formatted_compatible",
+                "original_questions_metadata": questions_data.get('metadata', {})
+            }
         
         # Save result
         try:
-            with open(output_file, 'w', encoding='utf-8') as f:
-                json.dump(merged_data, f, ensure_ascii=False, indent=2)
+            metadata = self.write_result(output_file, merged_questions, build_metadata, pretty)
             
             print(f"\n✅ MERGE COMPLETED!")
             print(f"📄 Result file: {output_file}")
             print(f"📊 Statistics:")
-            print(f"   - Total questions: {len(merged_data['questions'])}")
-            print(f"   - With explanations: {matched_count}")
-            print(f"   - Match rate: {matched_count/len(merged_data['questions'])*100:.1f}%")
+            print(f"   - Total questions: {stats['total']}")
+            print(f"   - With explanations: {stats['matched']}")
+            print(f"   - Match rate: {stats['matched']/stats['total']*100:.1f}%")
             
             # Show field distribution
-            questions_with_fields = merged_data['questions']
-            
-            # Count question types
-            math_count = sum(1 for q in questions_with_fields if q.get('type') == 'math')
-            reading_count = sum(1 for q in questions_with_fields if q.get('type') == 'reading_and_writing')
-            
             print(f"\n📈 Question type distribution:")
-            print(f"   - Math: {math_count} questions")
-            print(f"   - Reading and Writing: {reading_count} questions")
-            
-            # Count fields_by_ai_gen
-            with_ai_fields = sum(1 for q in questions_with_fields if q.get('fields_by_ai_gen'))
-            print(f"   - With AI-generated fields: {with_ai_fields} questions")
-            
-            # Count question_page
-            with_page_numbers = sum(1 for q in questions_with_fields if q.get('question_page') is not None)
-            print(f"   - With page numbers: {with_page_numbers} questions")
+            print(f"   - Math: {stats['math']} questions")
+            print(f"   - Reading and Writing: {stats['reading']} questions")
+            print(f"   - With AI-generated fields: {stats['ai']} questions")
+            print(f"   - With page numbers: {stats['page']} questions")
             
             # Show examples
-            questions_with_explanations = [q for q in questions_with_fields if q.get('explanation')]
-            if questions_with_explanations:
+            if samples:
                 print(f"\n📝 SAMPLE MERGED QUESTIONS:")
-                for i, q in enumerate(questions_with_explanations[:2], 1):
+                for i, q in enumerate(samples, 1):
                     print(f"\n--- Example {i} ---")
                     print(f"Type: {q.get('type', 'N/A')}")
                     print(f"Domain: {q.get('domain', 'N/A')}")
@@ -221,7 +260,7 @@ class QuestionExplanationMerger:
                     print(f"Options: {len(q.get('options', []))} choices")
                     print("-" * 40)
             
-            return merged_data
+            return metadata
             
         except Exception as e:
             print(f"❌ Error saving file: {e}")
@@ -230,6 +269,12 @@ class QuestionExplanationMerger:
 def main():
     """Main function with updated default files"""
     
+    import argparse
+    
+    parser = argparse.ArgumentParser(description='Merge extracted explanations into the questions file')
+    parser.add_argument('--pretty', action='store_true', help='Indent the output JSON for reading (default: compact)')
+    args = parser.parse_args()
+    
     # Updated default file paths
     questions_file = "questions_new.json"  # Updated to use question_new.json
     explanations_file = "explanations.json"  # Updated to use explanations.json
@@ -254,7 +299,7 @@ def main():
     
     # Merge
     merger = QuestionExplanationMerger()
-    result = merger.merge_files(questions_file, explanations_file, output_file)
+    result = merger.merge_files(questions_file, explanations_file, output_file, pretty=args.pretty)
     
     if result:
         print(f"\n🎉 Merge successful!")
@@ -9,11 +9,10 @@ def parse_pipe_options(options_text):
         return []
     
     options = []
-    parts = options_text.split(' | ')
-    
-    for part in parts:
-        if ':' in part:
-            value, text = part.split(':', 1)
+    for part in options_text.split(' | '):
+        # partition finds the first colon and splits in one step, without building a list
+        value, colon, text = part.partition(':')
+        if colon:
             options.append({
                 'value': value.strip(),
                 'text': text.strip()
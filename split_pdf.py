@@ -1,6 +1,15 @@
 import PyPDF2
 import os
-import math
+
+def write_pages(pdf_reader, start_page, end_page, output_path):
+    """Copy pages start_page to end_page - 1 of an open PDF into a new file"""
+    pdf_writer = PyPDF2.PdfWriter()
+    
+    for page_num in range(start_page, end_page):
+        pdf_writer.add_page(pdf_reader.pages[page_num])
+    
+    with open(output_path, 'wb') as output_file:
+        pdf_writer.write(output_file)
 
 def split_pdf(input_file, pages_per_file=10):
     """
@@ -24,9 +33,9 @@ def split_pdf(input_file, pages_per_file=10):
         print(f"Original file has {total_pages} pages")
         print(f"Will split into {pages_per_file} pages per file")
         
-        # Calculate number of files to be created
-        num_files = math.ceil(total_pages / pages_per_file)
-        print(f"Will create {num_files} files")
+        # First page of each file to be created
+        page_starts = range(0, total_pages, pages_per_file)
+        print(f"Will create {len(page_starts)} files")
         
         # Create directory to hold the split files
         base_name = os.path.splitext(input_file)[0]
@@ -37,25 +46,14 @@ def split_pdf(input_file, pages_per_file=10):
             print(f"Created directory: {output_dir}")
         
         # Split file
-        for i in range(num_files):
-            start_page = i * pages_per_file
-            end_page = min((i + 1) * pages_per_file, total_pages)
-            
-            # Create new PDF file
-            pdf_writer = PyPDF2.PdfWriter()
-            
-            # Add pages to new file
-            for page_num in range(start_page, end_page):
-                pdf_writer.add_page(pdf_reader.pages[page_num])
+        for i, start_page in enumerate(page_starts):
+            end_page = min(start_page + pages_per_file, total_pages)
             
             # New file name
             output_filename = f"{base_name}_part{i+1:02d}_pages{start_page+1}-{end_page}.pdf"
             output_path = os.path.join(output_dir, os.path.basename(output_filename))
             
-            # Write file
-            with open(output_path, 'wb') as output_file:
-                pdf_writer.write(output_file)
-            
+            write_pages(pdf_reader, start_page, end_page, output_path)
             print(f"Created: {output_path} (pages {start_page+1}-{end_page})")
         
         print(f"\nDone! Files saved in directory: {output_dir}")
@@ -0,0 +1,36 @@
+import os
+import unittest
+
+os.environ.setdefault('GEMINI_KEY', 'test-key')
+
+from batch_extract_v2_questions import SimplifiedBatchSATExtractor
+
+
+def question(text):
+    return {'question_text': text}
+
+
+class RemoveDuplicatesTest(unittest.TestCase):
+    def setUp(self):
+        self.extractor = SimplifiedBatchSATExtractor()
+
+    def test_empty_input(self):
+        self.assertEqual(self.extractor.remove_duplicates([]), [])
+
+    def test_single_question(self):
+        questions = [question('What is the value of x if 2x + 3 = 11?')]
+        self.assertEqual(self.extractor.remove_duplicates(questions), questions)
+
+    def test_keeps_longest_of_similar_questions(self):
+        short = question('What is the value of x in the equation 2x + 3 = 11 shown')
+        long = question('What is the value of x in the equation 2x + 3 = 11 shown above?')
+        other = question('Which choice best describes the main purpose of the passage?')
+        self.assertEqual(self.extractor.remove_duplicates([short, other, long]), [other, long])
+
+    def test_numpy_prefilter_empty_and_single(self):
+        self.assertEqual(self.extractor.find_similar_pairs_numpy([], []), [])
+        self.assertEqual(self.extractor.find_similar_pairs_numpy(['only one'], [frozenset({'only', 'one'})]), [])
+
+
+if __name__ == '__main__':
+    unittest.main()